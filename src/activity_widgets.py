@@ -24,6 +24,7 @@
 import datetime
 import gobject
 import gtk
+import itertools
 import math
 import urllib
 from urlparse import urlparse
@@ -38,7 +39,7 @@ except ImportError:
 from common import *
 import content_objects
 from config import event_exists, settings, bookmarker, SUPPORTED_SOURCES, UCL_INTERPRETATIONS
-from store import ContentStruct, CLIENT
+from store import ContentStruct, CLIENT, STORE
 from supporting_widgets import DayLabel, ContextMenu, ContextMenuMolteplicity, StaticPreviewTooltip, VideoPreviewTooltip,\
 SearchBox, AudioPreviewTooltip
 from zeitgeist.datamodel import ResultType, StorageState, TimeRange
@@ -225,21 +226,18 @@ class DayViewContainer(gtk.VBox):
             self.box.reorder_child(pinbox, 0)
         self.daylabel.set_date(day.date)
         
-        parts = [[] for i in DayParts.get_day_parts()]
-        uris = [[] for i in parts]
-        
-        list = day.filter(self.event_templates, result_type=ResultType.MostRecentEvents)
-        for item in list:
-            if not item.content_object:
-                continue
-            i = DayParts.get_day_part_for_item(item)
-            uri = item.event.subjects[0].uri
-            interpretation = item.event.interpretation
-            if not uri in uris[i]:
-                uris[i].append(uri)
-                parts[i].append(item)
-        
-        for i, part in enumerate(parts):
+        day_parts = day.filter_day_parts(self.event_templates,
+            result_type=ResultType.MostRecentEvents)
+        for i, items in enumerate(day_parts):
+            part = []
+            uris = set()
+            for item in items:
+                if not item.content_object:
+                    continue
+                uri = item.uri
+                if not uri in uris:
+                    uris.add(uri)
+                    part.append(item)
             self.dayviews[i].set_items(part)
 
     def change_style(self, this, old_style):
@@ -876,7 +874,11 @@ class _ThumbViewRenderer(gtk.GenericCellRenderer):
         y = cell_area.y
         w = cell_area.width
         h = cell_area.height
-        pixbuf, isthumb = self.pixbuf
+        if self.content_obj.thumbnail_pending:
+            widget.request_thumbnail(self.content_obj, THUMBNAIL_PRIORITY_VISIBLE)
+            pixbuf, isthumb = PLACEHOLDER_PIXBUFFS[24], False
+        else:
+            pixbuf, isthumb = self.pixbuf
         if pixbuf and isthumb and "audio-x-generic" not in self.content_obj.icon_names:
             render_pixbuf(window, x, y, pixbuf, w, h)
         else:
@@ -980,6 +982,8 @@ class ThumbIconView(gtk.IconView, Draggable):
         self.active_list = []
         self.current_size_index = 1
         self.in_erase_mode = False
+        self._generation = 0#bumped by every set_model_from_list
+        self._rows = {}#uri:[gtk.TreeRowReference]
         self.popupmenu = ContextMenu
         self.popupmenu_molteplicity = ContextMenuMolteplicity
         
@@ -1012,51 +1016,67 @@ class ThumbIconView(gtk.IconView, Draggable):
         SearchBox.connect("search", lambda *args: self.queue_draw())
         SearchBox.connect("clear", lambda *args: self.queue_draw())
 
-    def _set_model_in_thread(self, items, grouped_items):
+    def _set_model_in_thread(self, items, grouped_items, generation):
         """
         A threaded which generates pixbufs and emblems for a list of events.
-        It takes those properties and appends them to the view's model
+        It takes those properties and appends them to the view's model.
+        It stops once a newer list was set.
         """
         lock = threading.Lock()
-        self.active_list = []
-        self.grouped_items = grouped_items
-        self.model.clear()
-        for item in items:
-            obj = item.content_object
+        #of the grouped items i take the first element in the list
+        rows = itertools.chain(((item.content_object, 0) for item in items),
+            ((item[0].content_object, len(item)) for item in grouped_items.values()))
+        for obj, molteplicity in rows:
             if not obj: continue
             gtk.gdk.threads_enter()
             lock.acquire()
-            self.active_list.append(False)
-            self.model.append([obj, SIZE_THUMBVIEW[self.current_size_index][0], 
-                                    SIZE_THUMBVIEW[self.current_size_index][1],
-                                    SIZE_TEXT_THUMBVIEW[self.current_size_index], 0])
-            lock.release()
-            gtk.gdk.threads_leave()
-            
-        for item in grouped_items.values():
-            #i take the first element in the list
-            obj = item[0].content_object
-            if not obj: continue
-            gtk.gdk.threads_enter()
-            lock.acquire()
-            self.active_list.append(False)
-            self.model.append([obj, SIZE_THUMBVIEW[self.current_size_index][0], 
+            try:
+                if generation != self._generation:
+                    return
+                self.active_list.append(False)
+                iter_ = self.model.append([obj, SIZE_THUMBVIEW[self.current_size_index][0],
                                     SIZE_THUMBVIEW[self.current_size_index][1],
-                                    SIZE_TEXT_THUMBVIEW[self.current_size_index], len(item)])
-            lock.release()
-            gtk.gdk.threads_leave()
-        
+                                    SIZE_TEXT_THUMBVIEW[self.current_size_index], molteplicity])
+                self._rows.setdefault(obj.uri, []).append(
+                    gtk.TreeRowReference(self.model, self.model.get_path(iter_)))
+                if obj.uri.startswith("file://"):
+                    self.request_thumbnail(obj)
+            finally:
+                lock.release()
+                gtk.gdk.threads_leave()
+
     def set_model_from_list(self, items, grouped_items):
         """
         Sets creates/sets a model from a list of zeitgeist events
         :param events: a list of :class:`Events <zeitgeist.datamodel.Event>`
         """
         self.last_active = -1
+        # The rows and thumbnails of the previous list are not needed anymore
+        self._generation += 1
+        THUMBNAILER.cancel(self)
         if not (items or grouped_items):
             return
-        thread = threading.Thread(target=self._set_model_in_thread, args=(items, grouped_items))
+        self.active_list = []
+        self.grouped_items = grouped_items
+        self._rows = {}
+        self.model.clear()
+        thread = threading.Thread(target=self._set_model_in_thread,
+            args=(items, grouped_items, self._generation))
         thread.start()
-        
+
+    def request_thumbnail(self, obj, priority=THUMBNAIL_PRIORITY_BACKGROUND):
+        """
+        Asks THUMBNAILER for the thumbnail of obj, its cell is redrawn once
+        the thumbnail is ready
+        """
+        THUMBNAILER.request(obj.uri, SIZE_LARGE, self._on_thumbnail_ready, self, priority)
+
+    def _on_thumbnail_ready(self, uri):
+        for reference in self._rows.get(uri, ()):
+            if reference.valid():
+                path = reference.get_path()
+                self.model.row_changed(path, self.model.get_iter(path))
+
     def set_zoom(self, size_index):
         self.current_size_index = size_index
         for row in self.model:
@@ -1215,29 +1235,23 @@ class ThumbView(gtk.VBox):
                 return
             
         self.old_date = day.date
-        parts = [[] for i in DayParts.get_day_parts()]
-        uris = [[] for i in parts]
-        grouped_items = [{} for i in parts]
+        day_parts = day.filter_day_parts(self.event_templates,
+            result_type=ResultType.MostRecentEvents)
+        parts = [[] for i in day_parts]
+        uris = [set() for i in day_parts]
+        grouped_items = [{} for i in day_parts]
         
-        list = day.filter(self.event_templates, result_type=ResultType.MostRecentEvents)
-        for item in list:
-            if event_exists(item.event.subjects[0].uri):
-                i = DayParts.get_day_part_for_item(item)
-                uri = item.event.subjects[0].uri
-                if not uri in uris[i]:
-                    if item.content_object: 
-                        if item.content_object.molteplicity:
-                            origin = urlparse(uri).netloc
-                            if origin not in grouped_items[i].keys():
-                                grouped_items[i][origin] = [item,]
-                            else:
-                                grouped_items[i][origin].append(item)
-                            
-                            uris[i].append(uri)
-                            continue
-                                
-                    uris[i].append(uri)
-                    parts[i].append(item)
+        for i, items in enumerate(day_parts):
+            for item in items:
+                uri = item.uri
+                if uri in uris[i] or not event_exists(uri):
+                    continue
+                uris[i].add(uri)
+                if item.content_object and item.content_object.molteplicity:
+                    origin = urlparse(uri).netloc
+                    grouped_items[i].setdefault(origin, []).append(item)
+                    continue
+                parts[i].append(item)
 
         for i, part in enumerate(parts):
             self.set_phase_items(i, part, grouped_items[i])
@@ -1522,12 +1536,16 @@ class TimelineView(gtk.TreeView, Draggable):
         gtk.TreeView.__init__(self)
         Draggable.__init__(self, self)
         
-        self.model = gtk.ListStore(gobject.TYPE_PYOBJECT, int, int, str)
+        # content object, width, height, text size, subject uri
+        self.model = gtk.ListStore(gobject.TYPE_PYOBJECT, int, int, str, str)
         self.set_model(self.model)
         self.popupmenu = ContextMenu
         self.zoom_slider = None
         self.in_erase_mode = False
         self.old_date = None
+        self._time_map = None
+        self._time_map_version = 0
+        self._iters = {}#uri:gtk.TreeIter
         self.add_events(gtk.gdk.LEAVE_NOTIFY_MASK | gtk.gdk.SCROLL_MASK )
         self.connect("button-press-event", self.on_button_press)
         self.connect("button-release-event", self.on_button_release)
@@ -1552,25 +1570,55 @@ class TimelineView(gtk.TreeView, Draggable):
         self.on_drag = False
         self.current_size_index = 1
 
+    def _get_row_values(self, row):
+        #take the last and more updated content_obj
+        item = row[len(row)-1][0]
+        obj = item.content_object
+        if not obj: return None
+        obj.phases = [self.make_area_from_event(start, duration) for (item, start, duration) in row]
+        obj.phases.sort(key=lambda x: x[0])
+        return [obj, SIZE_TIMELINEVIEW[self.current_size_index][0],
+                     SIZE_TIMELINEVIEW[self.current_size_index][1],
+                     SIZE_TEXT_TIMELINEVIEW[self.current_size_index],
+                     item.uri]
+
     def set_model_from_list(self, items):
         """
-        Sets creates/sets a model from a list of zeitgeist events
+        Sets creates/sets a model from a list of time map rows
 
-        :param events: a list of :class:`Events <zeitgeist.datamodel.Event>`
+        :param items: a list of rows as returned by Day.get_time_map
         """
-        if not items:
-            return
         self.model.clear()
+        self._iters = {}
         for row in items:
-            #take the last and more updated content_obj
-            item = row[len(row)-1][0]
-            obj = item.content_object
-            if not obj: continue
-            obj.phases = [self.make_area_from_event(item.event.timestamp, stop) for (item, stop) in row]
-            obj.phases.sort(key=lambda x: x[0])
-            self.model.append([obj, SIZE_TIMELINEVIEW[self.current_size_index][0],
-                                    SIZE_TIMELINEVIEW[self.current_size_index][1],
-                                    SIZE_TEXT_TIMELINEVIEW[self.current_size_index]])
+            values = self._get_row_values(row)
+            if values:
+                self._iters[values[4]] = self.model.append(values)
+
+    def update_model_from_changes(self, changes):
+        """
+        Updates only the rows of the model whose time map rows changed
+
+        :param changes: a dict of uri: row, as from Day.get_time_map_changes
+        """
+        for uri, row in changes.iteritems():
+            iter_ = self._iters.pop(uri, None)
+            values = self._get_row_values(row) if row else None
+            if not values:
+                if iter_:
+                    self.model.remove(iter_)
+                continue
+            if iter_:
+                self.model.set_row(iter_, values)
+                self._iters[uri] = iter_
+                continue
+            # Keep the rows ordered by the start of their first interval
+            position = -1
+            for i, model_row in enumerate(self.model):
+                if model_row[0].phases and model_row[0].phases[0][0] > values[0].phases[0][0]:
+                    position = i
+                    break
+            self._iters[uri] = self.model.insert(position, values)
 
     def set_day(self, day, force_update=False):
         if not force_update and self.old_date is not None:
@@ -1580,8 +1628,14 @@ class TimelineView(gtk.TreeView, Draggable):
                 return
             
         self.old_date = day.date
-        items = day.get_time_map()
-        self.set_model_from_list(items)
+        time_map = day.time_map
+        if time_map is self._time_map and not force_update:
+            self._time_map_version, changes = time_map.get_changes(self._time_map_version)
+            self.update_model_from_changes(changes)
+            return
+        self._time_map = time_map
+        self._time_map_version = time_map.version
+        self.set_model_from_list(time_map.get_rows())
     
     def set_zoom(self, size_index):
         if size_index > len(SIZE_TIMELINEVIEW) - 1 or size_index < 0: return
@@ -1624,6 +1678,7 @@ class TimelineView(gtk.TreeView, Draggable):
                 model = self.get_model()
                 obj = model[path[0]][0]
                 if self.in_erase_mode:
+                    self._iters.pop(model[path[0]][4], None)
                     model.remove(model[path[0]].iter)
                     self.popupmenu.do_delete_object(obj)
                 else:
@@ -1657,6 +1712,7 @@ class TimelineView(gtk.TreeView, Draggable):
         model = self.get_model()
         obj = model[path][0]
         if self.in_erase_mode:
+            self._iters.pop(model[path[0]][4], None)
             model.remove(model[path[0]].iter)
             self.popupmenu.do_delete_object(obj)
         else:
@@ -1771,9 +1827,9 @@ class PinBox(DayView, Droppable):
             self.do_set([])
 
     def do_set(self, event_ids):
-        objs = []
-        for id_ in event_ids:
-            objs += [ContentStruct(id_)]
+        STORE.get_events_from_ids(event_ids, self.do_set_structs)
+
+    def do_set_structs(self, objs):
         self.set_items(objs)
         # Make the pin icons visible
         self.view.show_all()
@@ -26,15 +26,21 @@ and handle colors, pixbufs, and text
 
 import cairo
 import collections
+import hashlib
+import heapq
+import itertools
 import gobject
 import gettext
 import gio
 import gnome.ui
 import glib
 import gtk
+import json
 import os
 import pango
 import pangocairo
+import Queue
+import threading
 import time
 import math
 import operator
@@ -57,7 +63,7 @@ try:
 except ImportError:
     chardet = None
 
-from config import get_data_path, get_icon_path, INTERPRETATION_UNKNOWN, MANIFESTATION_UNKNOWN
+from config import get_data_path, get_icon_path, settings, INTERPRETATION_UNKNOWN, MANIFESTATION_UNKNOWN
 
 from zeitgeist.datamodel import Interpretation, Event, Subject
 
@@ -635,42 +641,293 @@ def scale_to_fill(pixbuf, neww, newh):
     return pixbuf
 
 
-class PixbufCache(dict):
+# Megabytes the memory and disk tiers of the pixbuf cache may use
+PIXBUF_CACHE_MEMORY = 32
+PIXBUF_CACHE_DISK = 128
+PIXBUF_CACHE_PATH = os.path.expanduser("~/.cache/UCL/Journal/")
+
+
+def get_pixbuf_size(pixbuf):
     """
-    A pixbuf cache dict which stores, loads, and saves pixbufs to a cache and to
-    the users filesystem. The naming scheme for thumb files is based on hash()
+    :returns: the bytes used by the pixels of pixbuf
+    """
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
 
-    There are huge flaws with this object. It does not have a ceiling, and it
-    does not remove thumbnails from the file system. Essentially meaning the
-    cache directory can grow forever.
+class PixbufCache(object):
     """
-    def __init__(self, *args, **kwargs):
-        super(PixbufCache, self).__init__()
+    A two tier cache of uri: (pixbuf, isthumb).
+
+    The memory tier is a LRU bounded by the bytes of its pixbufs. The disk tier
+    keeps the pixbufs as png files named by a sha1 digest of the uri, mtime and
+    size of the file they were made from, so a changed file misses the cache.
+    It is bounded in size and evicts the least recently used files first, an
+    index file keeps the size and last use of every file across restarts.
+    Files are encoded and written by a background thread, and keep whether
+    they hold a thumbnail in a png text chunk so that files written after
+    the index was last saved can still be used.
+    """
+    index_name = "index.json"
+    # Most pixbufs encoded before the index is updated
+    write_batch = 16
+
+    def __init__(self, path=PIXBUF_CACHE_PATH):
+        self.path = path
+        self._memory = collections.OrderedDict()#uri:(pixbuf, isthumb), least recently used first
+        self._memory_bytes = 0
+        self._index = None#digest:[bytes, last use, isthumb], loaded on first use
+        self._disk_bytes = 0
+        self._save_source = None
+        # Disk writes are left to a writer thread, pending ones are still read
+        self._pending = {}#digest:(pixbuf, isthumb)
+        self._pending_lock = threading.Lock()
+        self._writes = Queue.Queue()
+        self._writer = None
+        self._ready = {}#uri:{size: mtime of the file when it was found ready}
+        self._memory_budget = self._disk_budget = None
+        self._on_budget_changed()
+        settings.connect("thumbnail_cache_memory", self._on_budget_changed)
+        settings.connect("thumbnail_cache_disk", self._on_budget_changed)
+
+    def _on_budget_changed(self, *args):
+        memory = settings.get("thumbnail_cache_memory", PIXBUF_CACHE_MEMORY)
+        disk = settings.get("thumbnail_cache_disk", PIXBUF_CACHE_DISK)
+        self._memory_budget = (memory or PIXBUF_CACHE_MEMORY) * 1024 * 1024
+        self._disk_budget = (disk or PIXBUF_CACHE_DISK) * 1024 * 1024
+        self._evict_from_memory()
+        if self._index is not None:
+            self._evict_from_disk()
+            self._index_changed()
+
+    def has_key(self, key):
+        return key in self._memory
+
+    __contains__ = has_key
 
     def check_cache(self, uri):
         return self[uri]
 
-    def get_buff(self, key):
-        thumbpath = os.path.expanduser("~/.cache/UCL/Journal/1_" + str(hash(key)))
-        if os.path.exists(thumbpath):
-            self[key] = (gtk.gdk.pixbuf_new_from_file(thumbpath), True)
-            return self[key]
-        return None
-
     def __getitem__(self, key):
-        if self.has_key(key):
-            return super(PixbufCache, self).__getitem__(key)
+        value = self._memory.pop(key, None)
+        if value is not None:
+            self._memory[key] = value
+            return value
         return self.get_buff(key)
 
     def __setitem__(self, key, (pb, isthumb)):
-        dir_ = os.path.expanduser("~/.cache/UCL/Journal/")
-        if not os.path.exists(os.path.expanduser("~/.cache/UCL/Journal/")):
-            os.makedirs(dir_)
-        path = dir_ + str(hash(isthumb)) + "_" + str(hash(key))
-        if not os.path.exists(path):
-            open(path, 'w').close()
-            pb.save(path, "png")
-        return super(PixbufCache, self).__setitem__(key, (pb, isthumb))
+        self._add_to_memory(key, (pb, isthumb))
+        digest = self._get_digest(key)
+        index = self._get_index()
+        if digest in index:
+            index[digest][1] = time.time()
+            self._index_changed()
+            return
+        with self._pending_lock:
+            if digest in self._pending:
+                return
+            self._pending[digest] = (pb, isthumb)
+        self._writes.put(digest)
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_pending)
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _write_pending(self):
+        """
+        Runs in the writer thread, encodes the pending pixbufs a batch at a
+        time and hands the written files to the main loop
+        """
+        while True:
+            digests = [self._writes.get()]
+            while len(digests) < self.write_batch:
+                try:
+                    digests.append(self._writes.get_nowait())
+                except Queue.Empty:
+                    break
+            written = []
+            for digest in digests:
+                with self._pending_lock:
+                    pb, isthumb = self._pending[digest]
+                path = os.path.join(self.path, digest + ".png")
+                try:
+                    pb.save(path + ".tmp", "png",
+                            {"tEXt::isthumb": isthumb and "1" or "0"})
+                    os.rename(path + ".tmp", path)
+                    written.append((digest, os.path.getsize(path), isthumb))
+                except (gobject.GError, OSError):
+                    written.append((digest, None, isthumb))
+            gobject.idle_add(self._add_written, written)
+
+    def _add_written(self, written):
+        index = self._get_index()
+        for digest, size, isthumb in written:
+            if size is not None:
+                index[digest] = [size, time.time(), isthumb]
+                self._disk_bytes += size
+            with self._pending_lock:
+                del self._pending[digest]
+        self._evict_from_disk()
+        self._index_changed()
+        return False
+
+    def get_buff(self, key):
+        """
+        Loads key from the disk tier into the memory tier
+
+        :returns: a (pixbuf, isthumb) tuple or None if key is not on disk
+        """
+        digest = self._get_digest(key)
+        with self._pending_lock:
+            value = self._pending.get(digest)
+        if value is not None:
+            self._add_to_memory(key, value)
+            return value
+        entry = self._get_index().get(digest)
+        if entry is None:
+            return None
+        try:
+            pb = gtk.gdk.pixbuf_new_from_file(os.path.join(self.path, digest + ".png"))
+        except gobject.GError:
+            self._remove_from_disk(digest)
+            self._index_changed()
+            return None
+        if entry[2] is None:
+            # Registered from the directory, the file knows what it holds
+            entry[2] = pb.get_option("tEXt::isthumb") == "1"
+        entry[1] = time.time()
+        self._index_changed()
+        value = (pb, entry[2])
+        self._add_to_memory(key, value)
+        return value
+
+    def _add_to_memory(self, key, value):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= get_pixbuf_size(old[0])
+        self._memory[key] = value
+        self._memory_bytes += get_pixbuf_size(value[0])
+        self._evict_from_memory()
+
+    def _evict_from_memory(self):
+        while self._memory_bytes > self._memory_budget and len(self._memory) > 1:
+            key, (pb, isthumb) = self._memory.popitem(last=False)
+            self._ready.pop(key, None)
+            self._memory_bytes -= get_pixbuf_size(pb)
+
+    @staticmethod
+    def _get_digest(uri):
+        try:
+            path = gio.File(uri).get_path()
+            stat = os.stat(path) if path else None
+        except (OSError, TypeError):
+            stat = None
+        key = uri.encode("utf-8") if isinstance(uri, unicode) else uri
+        if stat:
+            key = "%s\0%d\0%d" % (key, stat.st_mtime, stat.st_size)
+        return hashlib.sha1(key).hexdigest()
+
+    def _get_index(self):
+        if self._index is not None:
+            return self._index
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            names = set(os.listdir(self.path))
+        except OSError:
+            names = set()
+        try:
+            with open(os.path.join(self.path, self.index_name)) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        self._index = dict((digest, entry) for digest, entry in index.iteritems()
+                           if digest + ".png" in names)
+        for name in names:
+            if name == self.index_name or name[:-4] in self._index:
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                if self._is_digest_name(name):
+                    # Written after the index was last saved
+                    stat = os.stat(path)
+                    self._index[name[:-4]] = [stat.st_size, stat.st_mtime, None]
+                    self._index_changed()
+                else:
+                    # Unfinished writes and the old hash() named files
+                    os.remove(path)
+            except OSError:
+                pass
+        self._disk_bytes = sum(entry[0] for entry in self._index.itervalues())
+        self._evict_from_disk()
+        return self._index
+
+    @staticmethod
+    def _is_digest_name(name):
+        digest, extension = os.path.splitext(name)
+        return extension == ".png" and len(digest) == 40 and \
+            not digest.strip("0123456789abcdef")
+
+    def _remove_from_disk(self, digest):
+        entry = self._index.pop(digest)
+        self._disk_bytes -= entry[0]
+        try:
+            os.remove(os.path.join(self.path, digest + ".png"))
+        except OSError:
+            pass
+
+    def _evict_from_disk(self):
+        if self._disk_bytes <= self._disk_budget:
+            return
+        for digest in sorted(self._index, key=lambda digest: self._index[digest][1]):
+            self._remove_from_disk(digest)
+            if self._disk_bytes <= self._disk_budget:
+                break
+
+    def _index_changed(self):
+        if self._save_source is None:
+            self._save_source = gobject.timeout_add_seconds(5, self.save_index)
+
+    def save_index(self):
+        """
+        Writes the index file, replacing the old one at once
+        """
+        self._save_source = None
+        if self._index is None:
+            return False
+        path = os.path.join(self.path, self.index_name)
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(self._index, f, separators=(",", ":"))
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError):
+            print "Thumbnail cache index could not be saved."
+        return False
+
+    def is_ready(self, uri, size=SIZE_LARGE):
+        """
+        :returns: False if get_pixbuf_from_uri would have to load or generate a
+        thumbnail, which THUMBNAILER can do instead
+
+        Once found ready, a uri stays ready for size until its mtime changes,
+        so redraws skip the stat and the digest of the cache lookup.
+        """
+        gfile = GioFile.create(uri)
+        mtime = gfile.mtime if gfile else None
+        ready_sizes = self._ready.get(uri, {})
+        if size in ready_sizes and ready_sizes[size] == mtime:
+            return True
+        ready = False
+        try:
+            ready = bool(self.check_cache(uri))
+        except gobject.GError:
+            pass
+        if not ready:
+            ready = not (gfile and gfile.has_preview()) or gfile.has_cached_thumbnail(size)
+        if ready:
+            self._ready.setdefault(uri, {})[size] = mtime
+        else:
+            ready_sizes.pop(size, None)
+        return ready
 
     def get_pixbuf_from_uri(self, uri, size=SIZE_LARGE, iconscale=1):
         """
@@ -720,6 +977,47 @@ class PixbufCache(dict):
 PIXBUFCACHE = PixbufCache()
 
 
+# Megabytes used by scaled and framed pixbufs
+SCALED_PIXBUF_CACHE_MEMORY = 16
+
+class ScaledPixbufCache(object):
+    """
+    A LRU of pixbufs derived from a source pixbuf by scaling or framing, keyed
+    by (source, width, height, mode) and bounded by the bytes of its pixbufs.
+    The source is usually the uri of the file the pixbuf was made from.
+
+    Each entry keeps the version of its source, the mtime of the file, and is
+    dropped when it is asked for with another one.
+    """
+    def __init__(self, budget=SCALED_PIXBUF_CACHE_MEMORY):
+        self.budget = budget * 1024 * 1024
+        self._pixbufs = collections.OrderedDict()#key:(version, pixbuf), least recently used first
+        self._bytes = 0
+
+    def get_pixbuf(self, key, version, func, *args):
+        """
+        :returns: the pixbuf cached for key and version, else the one returned
+        by func(*args), which is cached
+        """
+        entry = self._pixbufs.pop(key, None)
+        if entry is not None:
+            if entry[0] == version:
+                self._pixbufs[key] = entry
+                return entry[1]
+            self._bytes -= get_pixbuf_size(entry[1])
+        pixbuf = func(*args)
+        if pixbuf is None:
+            return None
+        self._pixbufs[key] = (version, pixbuf)
+        self._bytes += get_pixbuf_size(pixbuf)
+        while self._bytes > self.budget and len(self._pixbufs) > 1:
+            version, old = self._pixbufs.popitem(last=False)[1]
+            self._bytes -= get_pixbuf_size(old)
+        return pixbuf
+
+SCALED_PIXBUFS = ScaledPixbufCache()
+
+
 def get_icon_for_name(name, size):
     """
     return a icon for a name
@@ -806,35 +1104,167 @@ def launch_string_command(command):
 ## GioFile
 ##
 
-GIO_FILES = {}
+# Most GioFiles kept by GioFile.create
+GIO_FILES_BUDGET = 2000
+# Pending files of a directory from which it is enumerated instead of
+# querying each file
+GIO_FILES_BATCH = 4
+# Most children read from one enumerated directory, the files it did not
+# reach are then queried one by one
+GIO_FILES_ENUMERATE_LIMIT = 500
+GIO_FILE_ATTRIBUTES = "standard::content-type,standard::icon,time::modified"
+
+class GioFileRegistry(object):
+    """
+    A LRU of uri: GioFile used by GioFile.create.
+
+    It also resolves the info of new GioFiles asynchronously. Requests made
+    during one main loop iteration are grouped by directory, a directory with
+    several of them is enumerated at once with enumerate_children, the others
+    are queried one by one with query_info_async. The enumeration of a large
+    directory stops after GIO_FILES_ENUMERATE_LIMIT children and leaves the
+    rest to query_info_async. A GioFile used before its info arrives queries
+    it synchronously.
+    """
+    def __init__(self, budget=GIO_FILES_BUDGET):
+        self.budget = budget
+        self._files = collections.OrderedDict()#uri:GioFile, least recently used first
+        self._pending = {}#parent uri:{uri:[GioFile]}
+        self._flush_source = None
+        # GioFiles are also made by the thumbnail threads
+        self._lock = threading.Lock()
+
+    def get(self, uri):
+        with self._lock:
+            gfile = self._files.pop(uri, None)
+            if gfile is not None:
+                self._files[uri] = gfile
+            return gfile
+
+    def add(self, uri, gfile):
+        with self._lock:
+            self._files.pop(uri, None)
+            self._files[uri] = gfile
+            while len(self._files) > self.budget:
+                self._files.popitem(last=False)
+
+    def request_info(self, gfile):
+        parent = gfile._file_object.get_parent()
+        parent_uri = parent.get_uri() if parent else None
+        with self._lock:
+            self._pending.setdefault(parent_uri, {}).setdefault(gfile.uri, []).append(gfile)
+            if self._flush_source is None:
+                # Before GTK's redraw, so the first draw finds the queries
+                # started
+                self._flush_source = gobject.idle_add(self._flush,
+                    priority=gobject.PRIORITY_HIGH_IDLE)
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flush_source = None
+        for parent_uri, files in pending.items():
+            # Files which were used meanwhile queried their info already
+            for uri, waiting in files.items():
+                waiting = [gfile for gfile in waiting if gfile._info is None]
+                if waiting:
+                    files[uri] = waiting
+                else:
+                    del files[uri]
+            if not files:
+                continue
+            if parent_uri is not None and len(files) >= GIO_FILES_BATCH:
+                gio.File(parent_uri).enumerate_children_async(
+                    GIO_FILE_ATTRIBUTES + ",standard::name", self._on_enumerated, user_data=files)
+            else:
+                self._query_files(files)
+        return False
 
-class GioFile(object):
+    def _query_files(self, files):
+        for waiting in files.itervalues():
+            waiting[0]._file_object.query_info_async(
+                GIO_FILE_ATTRIBUTES, self._on_info, user_data=waiting)
 
-    def __new__(classtype, *args, **kwargs):
-        # Check to see if a __single exists already for this class
-        # Compare class types instead of just looking for None so
-        # that subclasses will create their own __single objects
-        subj = args[0][1][0][0]
-        if not GIO_FILES.has_key(subj):
-            GIO_FILES[subj] = object.__new__(classtype)
-        return GIO_FILES[subj]
+    def _on_info(self, file_object, result, waiting):
+        try:
+            info = file_object.query_info_finish(result)
+        except gio.Error:
+            return
+        for gfile in waiting:
+            if gfile._info is None:
+                gfile.set_info(info)
+
+    def _on_enumerated(self, parent, result, files):
+        try:
+            enumerator = parent.enumerate_children_finish(result)
+        except gio.Error:
+            self._query_files(files)
+            return
+        enumerator.next_files_async(100, self._on_next_files, user_data=(parent, files, 0))
+
+    def _on_next_files(self, enumerator, result, (parent, files, read)):
+        try:
+            infos = enumerator.next_files_finish(result)
+        except gio.Error:
+            infos = []
+        read += len(infos)
+        for info in infos:
+            waiting = files.pop(parent.get_child(info.get_name()).get_uri(), None)
+            for gfile in waiting or ():
+                if gfile._info is None:
+                    gfile.set_info(info)
+        if infos and files and read < GIO_FILES_ENUMERATE_LIMIT:
+            enumerator.next_files_async(100, self._on_next_files,
+                user_data=(parent, files, read))
+            return
+        enumerator.close_async(self._on_closed)
+        if infos and files:
+            self._query_files(files)
+
+    def _on_closed(self, enumerator, result, *args):
+        try:
+            enumerator.close_finish(result)
+        except gio.Error:
+            pass
+
+GIO_FILES = GioFileRegistry()
+
+class GioFile(object):
 
     @classmethod
     def create(cls, path):
         """ save method to create a GioFile object, if a file does not exist
         None is returned"""
-        try:
-            if not GIO_FILES.has_key(path):
-                GIO_FILES[path] = cls(path)
-            return GIO_FILES[path]
-        except gio.Error:
-            return None
+        gfile = GIO_FILES.get(path)
+        if gfile is None:
+            try:
+                gfile = cls(path)
+            except gio.Error:
+                return None
+            GIO_FILES.add(path, gfile)
+        return gfile
 
     def __init__(self, path):
         self._file_object = gio.File(path)
-        self._file_info = self._file_object.query_info(
-            "standard::content-type,standard::icon,time::modified")
-        self._file_annotation = self._file_object.query_info("metadata::annotation")
+        local_path = self._file_object.get_path()
+        if local_path is not None and not os.path.lexists(local_path):
+            # raises the gio.Error expected for missing files
+            self._file_object.query_info("standard::type")
+        self._info = None
+        self._file_annotation = None
+        GIO_FILES.request_info(self)
+
+    def set_info(self, info):
+        self._info = info
+
+    @property
+    def _file_info(self):
+        if self._info is None:
+            try:
+                self._info = self._file_object.query_info(GIO_FILE_ATTRIBUTES)
+            except gio.Error:
+                return gio.FileInfo()
+        return self._info
 
     @property
     def mime_type(self):
@@ -857,6 +1287,8 @@ class GioFile(object):
         return self._file_annotation.get_attribute_as_string("metadata::annotation")
         
     def set_annotation(self, annotation):
+        if self._file_annotation is None:
+            self.refresh_annotation()
         self._file_annotation.set_attribute_string("metadata::annotation", annotation)
         self._file_object.set_attributes_from_info(self._file_annotation)
         
@@ -922,9 +1354,21 @@ class GioFile(object):
                     return self.get_thumbnail(size, border)
                 thumb = thumb[0]
         if thumb is not None and border:
-            thumb = make_icon_frame(thumb, border=border, color=0x00000080)
+            thumb = SCALED_PIXBUFS.get_pixbuf((self.uri, size[0], size[1], ("frame", border)),
+                self.mtime, lambda: make_icon_frame(thumb, border=border, color=0x00000080))
         return thumb
         
+    def has_cached_thumbnail(self, size=SIZE_NORMAL):
+        """
+        :returns: True if get_thumbnail does not have to load or generate the
+        thumbnail
+        """
+        try:
+            thumb = THUMBS[size][self.uri]
+        except KeyError:
+            return False
+        return thumb is None or thumb[1] == self.mtime
+
     def get_audio_cover(self, size):
         """
         Try to get a cover art in the folder of the song.
@@ -950,8 +1394,7 @@ class GioFile(object):
         return self._file_object.monitor_file()
 
     def refresh(self):
-        self._file_info = self._file_object.query_info(
-            "standard::content-type,standard::icon,time::modified")
+        self._info = self._file_object.query_info(GIO_FILE_ATTRIBUTES)
             
     def refresh_annotation(self):
         self._file_annotation = self._file_object.query_info("metadata::annotation")
@@ -968,11 +1411,8 @@ class GioFile(object):
                     thumb_size = SIZE_LARGE
                 thumb = self.get_thumbnail(size=thumb_size)
                 if thumb:
-                    s = float(size)
-                    width = thumb.get_width()
-                    height = thumb.get_height()
-                    scale = min(s/width, s/height)
-                    icon = thumb.scale_simple(int(width*scale), int(height*scale), gtk.gdk.INTERP_NEAREST)
+                    icon = SCALED_PIXBUFS.get_pixbuf((self.uri, size, size, "thumb icon"),
+                        self.mtime, self._scale_thumb_to_icon, thumb, size)
         if icon is None:
             try:
                 return ICONS[size][self.uri]
@@ -992,6 +1432,14 @@ class GioFile(object):
             icon = make_icon_frame(icon, border=border, color=0x00000080)
         return icon
 
+    @staticmethod
+    def _scale_thumb_to_icon(thumb, size):
+        s = float(size)
+        width = thumb.get_width()
+        height = thumb.get_height()
+        scale = min(s/width, s/height)
+        return thumb.scale_simple(int(width*scale), int(height*scale), gtk.gdk.INTERP_NEAREST)
+
     @property
     def icon(self):
         return self.get_icon()
@@ -1023,6 +1471,101 @@ class GioFile(object):
             return False
         return self.uri == other.uri
 
+# Threads making thumbnails, and the priorities of their requests
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_PRIORITY_VISIBLE = 0
+THUMBNAIL_PRIORITY_BACKGROUND = 1
+
+class ThumbnailService(object):
+    """
+    Makes the thumbnails of GioFile.get_thumbnail in a pool of worker threads,
+    so the views can draw a placeholder instead of waiting for them.
+
+    Requests for the same uri and size are merged, lower priorities are made
+    first and the requests of an owner can be cancelled at once. Callbacks are
+    called with the uri in the main loop, once get_thumbnail has it cached.
+    """
+    def __init__(self, workers=THUMBNAIL_WORKERS):
+        self.workers = workers
+        self._threads = []
+        self._queue = []#heap of (priority, order, (uri, size))
+        self._order = itertools.count()
+        self._requests = {}#(uri, size):{"priority", "callbacks", "running"}
+        self._condition = threading.Condition()
+
+    def request(self, uri, size, callback, owner=None, priority=THUMBNAIL_PRIORITY_BACKGROUND):
+        """
+        Queues a thumbnail, callback(uri) is called once it is ready unless
+        owner cancels before
+        """
+        key = (uri, size)
+        with self._condition:
+            request = self._requests.get(key)
+            if request is None:
+                request = self._requests[key] = {
+                    "priority" : None,
+                    "callbacks" : [],
+                    "running" : False,
+                }
+            if (owner, callback) not in request["callbacks"]:
+                request["callbacks"].append((owner, callback))
+            if request["running"] or (request["priority"] is not None and request["priority"] <= priority):
+                return
+            # A raised priority leaves the old entry behind, it is skipped
+            request["priority"] = priority
+            heapq.heappush(self._queue, (priority, self._order.next(), key))
+            self._condition.notify()
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def cancel(self, owner):
+        """
+        Drops the callbacks of owner, and the requests nobody waits for anymore
+        """
+        with self._condition:
+            for key, request in self._requests.items():
+                request["callbacks"] = [item for item in request["callbacks"] if item[0] is not owner]
+                if not request["callbacks"] and not request["running"]:
+                    del self._requests[key]
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while True:
+                    while not self._queue:
+                        self._condition.wait()
+                    key = heapq.heappop(self._queue)[2]
+                    request = self._requests.get(key)
+                    if request is not None and not request["running"]:
+                        break
+                request["running"] = True
+            uri, size = key
+            gfile = None
+            try:
+                gfile = GioFile.create(uri)
+                if gfile and gfile.has_preview():
+                    gfile.get_thumbnail(size)
+            except Exception:
+                pass
+            if gfile:
+                # A thumbnail which could not be made is not asked for again
+                THUMBS[size].setdefault(gfile.uri, None)
+            gobject.idle_add(self._finish, key)
+
+    def _finish(self, key):
+        with self._condition:
+            request = self._requests.pop(key, None)
+        if request:
+            for owner, callback in request["callbacks"]:
+                callback(key[0])
+        return False
+
+THUMBNAILER = ThumbnailService()
+
+
 class DayParts:
 
     # TODO: In a future, I'd be cool to make the day partitions configurable.
@@ -1047,7 +1590,14 @@ class DayParts:
 
     @classmethod
     def get_day_part_for_item(cls, item):
-        t = time.localtime(int(item.event.timestamp) / 1000)
+        return cls.get_day_part_for_timestamp(item.event.timestamp)
+
+    @classmethod
+    def get_day_part_for_timestamp(cls, timestamp):
+        """
+        :param timestamp: milliseconds since the epoch, as in events
+        """
+        t = time.localtime(int(timestamp) / 1000)
         return cls._local_minimum(t.tm_hour)
 
     @classmethod
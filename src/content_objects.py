@@ -31,6 +31,7 @@ import os
 import glob
 import sys
 import datetime
+import weakref
 from urlparse import urlparse
 from xdg import DesktopEntry
 import xml.dom.minidom as dom
@@ -61,11 +62,32 @@ class CachedAttribute(object):
         return value
 
 
+class FormattedAttribute(object):
+    """
+    Runs the wrapped field into string format with the instance's wrds the
+    first time it is read, and replaces the descriptor in the instance with
+    the found value
+    """
+    def __init__(self, name, field):
+        self.attr_name = name
+        self.field = field
+
+    def __get__(self, instance, cls):
+        if instance is None:
+            return self
+        value = self.field
+        if hasattr(value, "__get__"):
+            value = value.__get__(instance, cls)
+        value = value.format(**instance.wrds)
+        setattr(instance, self.attr_name, value)
+        return value
+
+
 class AbstractContentObject(object):
     """
-    Keeps a list of instances of this class
+    Keeps a weak set of the live instances of this class
     """
-    instances = []
+    instances = weakref.WeakSet()
 
     content_object_types = []
 
@@ -80,18 +102,66 @@ class AbstractContentObject(object):
     def remove_manager_connection(cls, identity):
         del cls._connections[identity[0]][identity[1]]
 
+    # interpretation uri: candidate types, in registration order
+    _dispatch = {}
+    # types which have to test every event themselves
+    _fallback = ()
+    # types the dispatch table already matched by interpretation
+    _indexed = frozenset()
+
+    @classmethod
+    def rebuild_dispatch(cls):
+        """
+        Rebuilds the interpretation index used to choose a type for an event.
+
+        Types which can tell their interpretations up front are only tried
+        for events with one of them, the others form a fallback chain which
+        is tried for every event. Both keep their registration order.
+        """
+        dispatch = {}
+        fallback = []
+        indexed = set()
+        for content_object_type in cls.content_object_types:
+            interpretations = content_object_type.dispatch_interpretations()
+            if interpretations is None:
+                fallback.append(content_object_type)
+                for candidates in dispatch.itervalues():
+                    candidates.append(content_object_type)
+                continue
+            indexed.add(content_object_type)
+            for interpretation in interpretations:
+                if interpretation not in dispatch:
+                    dispatch[interpretation] = list(fallback)
+                candidates = dispatch[interpretation]
+                if content_object_type not in candidates:
+                    candidates.append(content_object_type)
+        AbstractContentObject._dispatch = dict(
+            (interpretation, tuple(candidates)) for interpretation, candidates in dispatch.iteritems())
+        AbstractContentObject._fallback = tuple(fallback)
+        AbstractContentObject._indexed = frozenset(indexed)
+
+    @classmethod
+    def dispatch_interpretations(cls):
+        """
+        :returns: the event interpretation uris this type is used for, or None
+        if use_class has to be asked for every event
+        """
+        return None
+
     @classmethod
     def register_new_content_object_type(cls, content_object_type, index=None):
         if index != None:
             cls.content_object_types.insert(index, content_object_type)
         else:
             cls.content_object_types.append(content_object_type)
+        cls.rebuild_dispatch()
         for func in cls._connections["add"]:
             func(content_object_type)
 
     @classmethod
     def remove_content_object_type(cls, content_object_type):
         cls.content_object_types.remove(content_object_type)
+        cls.rebuild_dispatch()
         for func in cls._connections["remove"]:
             func(content_object_type)
 
@@ -104,13 +174,7 @@ class AbstractContentObject(object):
         no correct Content Object was found or if that the correct Content object
         rejected the given event
         """
-        for obj in cls.content_object_types:
-            instance = obj.use_class(event)
-            if instance:
-                return instance.create(event)
-        if event.subjects[0].uri.startswith("file://"):
-            return FileContentObject.create(event)
-        return GenericContentObject.create(event)
+        return cls.find_best_type_from_event(event).create(event)
 
     @classmethod
     def find_best_type_from_event(cls, event):
@@ -121,7 +185,10 @@ class AbstractContentObject(object):
         no correct Content Object was found or if that the correct Content object
         rejected the given event
         """
-        for obj in cls.content_object_types:
+        indexed = cls._indexed
+        for obj in cls._dispatch.get(event.interpretation, cls._fallback):
+            if obj in indexed:
+                return obj
             instance = obj.use_class(event)
             if instance:
                 return instance
@@ -131,11 +198,7 @@ class AbstractContentObject(object):
 
     def __init__(self):
         super(AbstractContentObject, self).__init__()
-        self.instances.append(self)
-
-    def __del__(self):
-        self.instances.remove(self)
-        return super(AbstractContentObject, self).__del__()
+        self.instances.add(self)
 
 
 class ContentObject(AbstractContentObject):
@@ -205,6 +268,11 @@ class ContentObject(AbstractContentObject):
         """:returns: tuple with containing a sized pixbuf for the timeline and a ispreview bool describing if it is a preview"""
         return None
 
+    @property
+    def thumbnail_pending(self):
+        """:returns: True while thumbview_pixbuf would have to wait for a thumbnail, see common.THUMBNAILER"""
+        return False
+
     # Icon methods
     def get_icon(self, size=24, *args, **kwargs):
         """
@@ -373,6 +441,11 @@ class FileContentObject(GioFile, ContentObject):
         thumbview_pixbuf, isthumb = common.PIXBUFCACHE.get_pixbuf_from_uri(self.uri, SIZE_LARGE)
         return thumbview_pixbuf, isthumb
 
+    @property
+    def thumbnail_pending(self):
+        return "thumbview_pixbuf" not in self.__dict__ \
+            and not common.PIXBUFCACHE.is_ready(self.uri, SIZE_LARGE)
+
     @CachedAttribute
     def timelineview_pixbuf(self):
         """Special method which returns a sized pixbuf for the timeline and a ispreview bool describing if it is a preview"""
@@ -395,9 +468,11 @@ class FileContentObject(GioFile, ContentObject):
         pix, isthumb = self.thumbview_pixbuf
         if pix is not None:
             if isthumb:
-                pix = common.scale_to_fill(pix, w, h)
+                pix = common.SCALED_PIXBUFS.get_pixbuf((self.uri, w, h, "fill"),
+                    self.mtime, common.scale_to_fill, pix, w, h)
             else:
-                pix = pix.scale_simple(w // 2, w // 2, gtk.gdk.INTERP_BILINEAR)
+                pix = common.SCALED_PIXBUFS.get_pixbuf((self.uri, w // 2, w // 2, "half"),
+                    self.mtime, pix.scale_simple, w // 2, w // 2, gtk.gdk.INTERP_BILINEAR)
         return pix,isthumb
 
 
@@ -434,28 +509,60 @@ class BaseContentType(ContentObject):
     # in this class's doctstring
     fields_to_format = ("text", "timelineview_text", "thumbview_text")
 
+    # (interpretation, subject interpretation, manifestation): format keywords
+    _words_cache = {}
+
     def __init__(self, event):
         super(BaseContentType, self).__init__(event)
-        # String formatting
-        self.wrds = wrds = {
-            "content_obj" : self,
-            "event" : event
-        }
-        try: wrds["interpretation"] = Interpretation[event.interpretation]
-        except KeyError: wrds["interpretation"] = Interpretation.ACCESS_EVENT
-        try: wrds["subject_interpretation"] = Interpretation[event.subjects[0].interpretation]
-        except KeyError: wrds["subject_interpretation"] = Interpretation
-        try:
-            wrds["source"] = SUPPORTED_SOURCES[self.event.subjects[0].interpretation]
-        except Exception:
-            wrds["source"] = SUPPORTED_SOURCES[""]
-        try:
-            wrds["manifestation"] = Manifestation[event.manifestation]
-        except Exception:
-            wrds["manifestation"] = Manifestation
-        for name in self.fields_to_format:
-            val = getattr(self, name)
-            setattr(self, name, val.format(**wrds))
+        cls = self.__class__
+        if "_formatted_fields" not in cls.__dict__:
+            cls._prepare_fields()
+
+    @classmethod
+    def _prepare_fields(cls):
+        """
+        Replaces the fields_to_format of this class with FormattedAttributes,
+        so each field is only formatted when it is first read
+        """
+        for name in cls.fields_to_format:
+            for klass in cls.__mro__:
+                if name in klass.__dict__:
+                    field = klass.__dict__[name]
+                    break
+            else:
+                continue
+            if not isinstance(field, FormattedAttribute):
+                setattr(cls, name, FormattedAttribute(name, field))
+        cls._formatted_fields = cls.fields_to_format
+
+    @classmethod
+    def _get_words(cls, event):
+        key = (event.interpretation, event.subjects[0].interpretation, event.manifestation)
+        wrds = cls._words_cache.get(key)
+        if wrds is None:
+            wrds = {}
+            try: wrds["interpretation"] = Interpretation[event.interpretation]
+            except KeyError: wrds["interpretation"] = Interpretation.ACCESS_EVENT
+            try: wrds["subject_interpretation"] = Interpretation[event.subjects[0].interpretation]
+            except KeyError: wrds["subject_interpretation"] = Interpretation
+            try:
+                wrds["source"] = SUPPORTED_SOURCES[event.subjects[0].interpretation]
+            except Exception:
+                wrds["source"] = SUPPORTED_SOURCES[""]
+            try:
+                wrds["manifestation"] = Manifestation[event.manifestation]
+            except Exception:
+                wrds["manifestation"] = Manifestation
+            BaseContentType._words_cache[key] = wrds
+        return wrds
+
+    @CachedAttribute
+    def wrds(self):
+        """The keywords fields are formatted with, see the class docstring"""
+        wrds = dict(self._get_words(self.event))
+        wrds["content_obj"] = self
+        wrds["event"] = self.event
+        return wrds
 
 
     def get_icon(self, size=24, *args, **kwargs):
@@ -491,14 +598,23 @@ class BaseContentType(ContentObject):
         else:
             thumbview_pixbuf = self.get_icon(SIZE_NORMAL[0])
         return thumbview_pixbuf, isthumb
+
+    @property
+    def thumbnail_pending(self):
+        return bool(self.thumbnail_uri) and "thumbview_pixbuf" not in self.__dict__ \
+            and not common.PIXBUFCACHE.is_ready(self.uri, SIZE_LARGE)
         
     def get_thumbview_pixbuf_for_size(self, w, h):
        pix, isthumb = self.thumbview_pixbuf
        if pix is not None:
            if isthumb:
-               pix = common.scale_to_fill(pix, w, h)
+               gfile = GioFile.create(self.uri)
+               pix = common.SCALED_PIXBUFS.get_pixbuf((self.uri, w, h, "fill"),
+                   gfile.mtime if gfile else None, common.scale_to_fill, pix, w, h)
            else:
-               pix = pix.scale_simple(w // 2, w // 2, gtk.gdk.INTERP_BILINEAR)
+               # icons are shared between uris, so they key themselves
+               pix = common.SCALED_PIXBUFS.get_pixbuf((pix, w // 2, w // 2, "half"),
+                   None, pix.scale_simple, w // 2, w // 2, gtk.gdk.INTERP_BILINEAR)
        return pix,isthumb
 
     @CachedAttribute
@@ -616,6 +732,10 @@ class UCLContentType(BaseContentType):
     def class_interpretation(cls):
         return ()
 
+    @classmethod
+    def dispatch_interpretations(cls):
+        return [UCL_INTERPRETATIONS[inter] for inter in cls.class_interpretation()]
+
     @property
     def category(self):
         return UCL_INTERPRETATIONS[self.__class__.class_interpretation()[-1]]
@@ -1277,4 +1397,5 @@ if sys.version_info >= (2,6):
          WebAccessObject, WebLeaveObject, WebDLObject, WebActiveObject,
          WindowOpenObject, WindowCloseObject, WindowTitleObject, WindowCrashObject, WindowActiveObject,
          IMContentObject, TomboyContentObject, GTGContentObject, EmailContentObject, HamsterContentObject))
+    AbstractContentObject.rebuild_dispatch()
 
@@ -0,0 +1,221 @@
+# -.- coding: utf-8 -.-
+#
+# UCL Study Journal - On-disk cache of the store's days
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import gobject
+import json
+import os
+import Queue
+import sqlite3
+import threading
+import time
+
+from zeitgeist.datamodel import Event
+
+from config import USER_DATA_PATH
+
+# Bump when the tables change, older caches are then dropped
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE population (day INTEGER PRIMARY KEY, count INTEGER);
+CREATE TABLE days (day INTEGER PRIMARY KEY, used REAL);
+CREATE TABLE events (id INTEGER PRIMARY KEY, day INTEGER, data TEXT);
+CREATE INDEX events_day ON events (day);
+CREATE TABLE deleted (uri TEXT PRIMARY KEY, timestamp INTEGER);
+"""
+
+
+def _pack_event(event):
+    # Only the metadata and the subjects are kept, payloads are dropped
+    return json.dumps([list(event[0]), [list(subject) for subject in event[1]]],
+                      separators=(",", ":"))
+
+def _unpack_event(data):
+    metadata, subjects = json.loads(data)
+    return Event([metadata, subjects, []])
+
+
+class DayCache(object):
+    """
+    A versioned SQLite file holding what the store needs to paint at
+    startup: the histogram population, the events of the days which were
+    loaded before and the deleted uris.
+
+    Days are keyed by their date ordinal. The cache is only a copy, the
+    store reconciles it with Zeitgeist whenever it queries a day. Only the
+    max_days most recently used days keep their events.
+
+    Every thread gets its own connection. The events of the days are read
+    and written in order by a worker thread, so a read sees the writes
+    queued before it and never blocks the main loop.
+    """
+
+    def __init__(self, path, max_days=None):
+        self.path = path
+        self.max_days = max_days
+        self._local = threading.local()
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self._create()
+        self._jobs = Queue.Queue()
+        self._worker = None
+
+    @property
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path)
+            db.text_factory = unicode
+        return db
+
+    @classmethod
+    def open(cls, path=None, max_days=None):
+        """
+        :returns: a DayCache, or None if the file can not be used
+        """
+        path = path or os.path.join(USER_DATA_PATH, "days.sqlite")
+        try:
+            return cls(path, max_days)
+        except sqlite3.Error:
+            try:
+                os.remove(path)
+                return cls(path, max_days)
+            except (OSError, sqlite3.Error):
+                print "Day cache could not be opened."
+        return None
+
+    def _create(self):
+        tables = self._db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        with self._db:
+            for (name,) in tables:
+                self._db.execute("DROP TABLE %s" % name)
+            self._db.executescript(SCHEMA)
+            self._db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+    def get_population(self):
+        """
+        :returns: a dict of date: count, empty if none was stored yet
+        """
+        rows = self._db.execute("SELECT day, count FROM population")
+        return dict((datetime.date.fromordinal(day), count) for day, count in rows)
+
+    def set_population(self, population):
+        self._queue(self._write_population, dict(population))
+
+    def _write_population(self, population):
+        with self._db:
+            self._db.execute("DELETE FROM population")
+            self._db.executemany("INSERT INTO population VALUES (?, ?)",
+                ((date.toordinal(), count) for date, count in population.iteritems()))
+
+    def get_events(self, date, callback):
+        """
+        Calls callback from the main loop with the events stored for date,
+        or with None if the day was never stored or could not be read
+        """
+        self._queue(self._read_events, date.toordinal(), callback)
+
+    def _read_events(self, day, callback):
+        events = None
+        try:
+            if self._db.execute("SELECT 1 FROM days WHERE day = ?", (day,)).fetchone():
+                rows = self._db.execute("SELECT data FROM events WHERE day = ?", (day,))
+                events = [_unpack_event(data) for (data,) in rows]
+                with self._db:
+                    self._db.execute("UPDATE days SET used = ? WHERE day = ?",
+                        (time.time(), day))
+        except (sqlite3.Error, ValueError):
+            print "Day cache could not be read."
+            events = None
+        gobject.idle_add(self._deliver, callback, events)
+
+    def _deliver(self, callback, events):
+        callback(events)
+        return False
+
+    def set_events(self, date, events):
+        """
+        Replaces the events stored for date
+        """
+        self._queue(self._write_events, date.toordinal(), list(events))
+
+    def _write_events(self, day, events):
+        with self._db:
+            self._db.execute("DELETE FROM events WHERE day = ?", (day,))
+            self._db.execute("INSERT OR REPLACE INTO days VALUES (?, ?)",
+                (day, time.time()))
+            self._db.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?)",
+                ((int(event.id), day, _pack_event(event)) for event in events))
+            if self.max_days:
+                # Drop the least recently used days beyond the budget
+                old = self._db.execute("SELECT day FROM days ORDER BY used DESC "
+                    "LIMIT -1 OFFSET ?", (self.max_days,)).fetchall()
+                self._db.executemany("DELETE FROM events WHERE day = ?", old)
+                self._db.executemany("DELETE FROM days WHERE day = ?", old)
+
+    def add_events(self, date, events):
+        """
+        Adds events to a day which was stored before
+        """
+        self._queue(self._write_added_events, date.toordinal(), list(events))
+
+    def _write_added_events(self, day, events):
+        if not self._db.execute("SELECT 1 FROM days WHERE day = ?", (day,)).fetchone():
+            return
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?)",
+                ((int(event.id), day, _pack_event(event)) for event in events))
+
+    def remove_ids(self, ids):
+        self._queue(self._write_removed_ids, set(ids))
+
+    def _write_removed_ids(self, ids):
+        with self._db:
+            self._db.executemany("DELETE FROM events WHERE id = ?",
+                ((int(id_),) for id_ in ids))
+
+    def get_deleted_uris(self):
+        """
+        :returns: a dict of uri: timestamp of its deletion
+        """
+        return dict(self._db.execute("SELECT uri, timestamp FROM deleted"))
+
+    def set_deleted_uris(self, deleted_uris):
+        self._queue(self._write_deleted_uris, dict(deleted_uris))
+
+    def _write_deleted_uris(self, deleted_uris):
+        with self._db:
+            self._db.execute("DELETE FROM deleted")
+            self._db.executemany("INSERT INTO deleted VALUES (?, ?)",
+                deleted_uris.iteritems())
+
+    def _queue(self, function, *args):
+        self._jobs.put((function, args))
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run_queued)
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _run_queued(self):
+        while True:
+            function, args = self._jobs.get()
+            try:
+                function(*args)
+            except sqlite3.Error:
+                print "Day cache could not be written."
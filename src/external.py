@@ -160,6 +160,69 @@ class Hamster(object):
     def __init__(self):
         self.hamster = BUS.get_object(HAMSTER_URI, HAMSTER_PATH)
         self.iface = dbus.Interface(self.hamster, dbus_interface=HAMSTER_URI)
+        self._events = {}#date:[HamsterEvent]
+        self._ranges = []#(first date, last date) fetched into _events
+        self._fact_ids = set()
+        self._listeners = []
+        self.iface.connect_to_signal("FactsChanged", self._on_facts_changed)
+
+    def _covers(self, date):
+        for first, last in self._ranges:
+            if first <= date <= last:
+                return True
+        return False
+
+    def fetch_range(self, first, last):
+        """
+        Fetches the facts from the first to the last date with one call and
+        keeps their events by date until Hamster reports a change. Dates at
+        either end which are fetched already are left out, and the fetched
+        ranges are merged so that they grow as neighbouring days load.
+        """
+        day = datetime.timedelta(days=1)
+        while first <= last and self._covers(first):
+            first += day
+        while first <= last and self._covers(last):
+            last -= day
+        if first > last:
+            return
+        start = time.mktime(first.timetuple())
+        end = time.mktime(last.timetuple()) + 86399
+        for fact in self.get_facts(start, end):
+            if fact.id in self._fact_ids:
+                continue
+            self._fact_ids.add(fact.id)
+            for event in fact.get_events():
+                date = datetime.date.fromtimestamp(int(event.timestamp)/1000)
+                self._events.setdefault(date, []).append(event)
+        ranges = []
+        for range_ in sorted(self._ranges + [(first, last)]):
+            if ranges and range_[0] <= ranges[-1][1] + day:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], range_[1]))
+            else:
+                ranges.append(range_)
+        self._ranges = ranges
+
+    def get_events_for_date(self, date):
+        """
+        :returns: the events of the facts on date, fetching the date if no
+        fetched range covers it
+        """
+        self.fetch_range(date, date)
+        return self._events.get(date, [])
+
+    def connect_changed(self, callback):
+        """
+        Calls callback without arguments after the facts changed
+        """
+        self._listeners.append(callback)
+
+    def _on_facts_changed(self, *args):
+        self._events = {}
+        self._ranges = []
+        self._fact_ids = set()
+        for callback in self._listeners:
+            callback()
 
     def get_facts(self, start=1, end=86400, date=None):
         if date:
@@ -140,9 +140,9 @@ class CairoHistogram(gtk.DrawingArea):
         self.bottom_padding = self.font_size + 9 + widget.style.ythickness
         self.gc = get_gc_from_colormap(widget, 0.6)
 
-    def set_store(self, store):
+    def set_store(self, store, dates=None):
         self._store = store
-        self.largest = min(max(max(map(lambda x: len(x), store.days)), 1), 200)
+        self.largest = min(max(store.get_max_population(), 1), 200)
         if not self.get_selected():
             self.set_selected([datetime.date.today()])
         else:
@@ -199,27 +199,38 @@ class CairoHistogram(gtk.DrawingArea):
         :param event: a gtk event with x and y values
         :param selected: a list of the selected dates
         """
-        x = self.start_x_padding
+        store = self.get_store()
+        dates = store.dates
+        width = self.start_x_padding + len(dates)*self.xincrement
+        # Only the exposed columns are drawn, month labels may start earlier
+        first = max(int((event.area.x - self.start_x_padding) / self.xincrement), 0)
+        last = min(int((event.area.x + event.area.width - self.start_x_padding) / self.xincrement) + 1, len(dates))
+        label_start = max(first - int(200 / self.xincrement), 0)
+        x = self.start_x_padding + label_start*self.xincrement
         months_positions = []
-        for day in self.get_store().days:            
-            if day.date.day == 1:
-                months_positions += [(day.date, x)]
-            if day.date in self._highlighted:
-                color = self.colors["column_selected_alternative"] if day.date in selected else self.colors["column_alternative"]
-            elif day.date in selected:
+        for i in xrange(label_start, last):
+            date = dates[i]
+            if date.day == 1:
+                months_positions += [(date, x)]
+            if i < first:
+                x += self.xincrement
+                continue
+            if date in self._highlighted:
+                color = self.colors["column_selected_alternative"] if date in selected else self.colors["column_alternative"]
+            elif date in selected:
                 color = self.colors["column_selected"]
             else:
                 color = self.colors["column_normal"]
-            self.draw_column(context, x, event.area.height, len(day), color)
+            self.draw_column(context, x, event.area.height, store.get_population(date), color)
             x += self.xincrement
-        if x > event.area.width: # Check for resize
-            self.set_size_request(x+self.xincrement, event.area.height)
+        if width > self.allocation.width: # Check for resize
+            self.set_size_request(width+self.xincrement, event.area.height)
         for date, xpos in months_positions:
             edge = 0
-            if (date, xpos) == months_positions[-1]:
-                edge = len(self._store)*self.xincrement
+            if dates and (date.year, date.month) == (dates[-1].year, dates[-1].month):
+                edge = width
             self.draw_month(context, xpos - self.padding, event.area.height, date, edge)
-        self.max_width = x # remove me
+        self.max_width = width # remove me
 
     def draw_column(self, context, x, maxheight, nitems, color):
         """
@@ -337,7 +348,7 @@ class CairoHistogram(gtk.DrawingArea):
         Reacts to mouse moving (while pressed), and clicks
         """
         #if (event.state == gtk.gdk.BUTTON1_MASK and not self._disable_mouse_motion):
-        location = min((self.get_store_index_from_cartesian(event.x, event.y), len(self._store.days) - 1))
+        location = min((self.get_store_index_from_cartesian(event.x, event.y), len(self._store.dates) - 1))
         if location != self._last_location:
             self.change_location(location)
             self._last_location = location
@@ -348,7 +359,7 @@ class CairoHistogram(gtk.DrawingArea):
         if (event.y > self.get_size_request()[1] - self.bottom_padding and
             event.y < self.get_size_request()[1]):
             return False
-        location = min((self.get_store_index_from_cartesian(event.x, event.y), len(self._store.days) - 1))
+        location = min((self.get_store_index_from_cartesian(event.x, event.y), len(self._store.dates) - 1))
         if location != self._last_location:
             self.change_location(location)
             self._last_location = location
@@ -356,9 +367,9 @@ class CairoHistogram(gtk.DrawingArea):
 
     def mouse_scroll_interaction(self, widget, event):
         date = self.get_selected()[-1]
-        i = self.get_store().dates.index(date)
+        i = self.get_store().get_date_index(date)
         if (event.direction in (gtk.gdk.SCROLL_UP, gtk.gdk.SCROLL_RIGHT)):
-            if i+1< len(self.get_store().days):
+            if i+1< len(self.get_store().dates):
                 self.change_location(i+1)
         elif (event.direction in (gtk.gdk.SCROLL_DOWN, gtk.gdk.SCROLL_LEFT)):
             if 0 <= i-1:
@@ -372,7 +383,7 @@ class CairoHistogram(gtk.DrawingArea):
             if location < 0:
                 return False
             store = self.get_store()
-            date = store.days[location].date
+            date = store.dates[location]
         else: date = location
         self.emit("column_clicked", date)
         return True
@@ -427,15 +438,25 @@ class TooltipEventBox(gtk.EventBox):
                 self._saved_tooltip_location = location
                 return False
             try:
-                day = self.histogram.get_store().days[location]
+                store = self.histogram.get_store()
+                day = store[store.dates[location]]
                 count = len(day)
             except IndexError:
                 # there is no bar for at this location
                 # don't show a tooltip
                 return False
             date = day.date.strftime("%A, %d %B, %Y")
-            tooltip.set_text("%s\n%i %s" % (date, count,
-                                            gettext.ngettext("item", "items", count)))
+            text = "%s\n%i %s" % (date, count, gettext.ngettext("item", "items", count))
+            if day._loaded and count:
+                # Only for days which are loaded already, the tooltip does
+                # not load any
+                columns = day.columns
+                subjects = columns.count_subjects()
+                hours = columns.count_by_hour()
+                text += "\n%i %s, %s %02d:00" % (subjects,
+                    gettext.ngettext("subject", "subjects", subjects),
+                    _("busiest at"), hours.index(max(hours)))
+            tooltip.set_text(text)
         else:
             return False
         return True
@@ -545,7 +566,7 @@ class HistogramWidget(gtk.Viewport):
         if not len(dates):
             return
         store = widget.get_store()
-        i = store.dates.index(dates[0])
+        i = store.get_date_index(dates[0])
         hadjustment = self.get_hadjustment()
         proposed_xa = ((i) * self.histogram.xincrement) + self.histogram.start_x_padding
         proposed_xb = ((i + len(dates)) * self.histogram.xincrement) + self.histogram.start_x_padding
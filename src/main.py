@@ -278,6 +278,7 @@ class PortalWindow(gtk.Window):
     def set_day(self, day):
         self.throbber_popup_button.image.animate_for_seconds(1)
         self.day_iter = day
+        self.store.set_focus(day.date, self.active_dates)
         self.handle_button_sensitivity(day.date)
         self.view.set_day(day)
         self.histogram.set_dates(self.active_dates)
@@ -19,21 +19,56 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import bisect
+import calendar
+import collections
 import datetime
 import dbus
 import gobject
 import gtk
+import heapq
+import Queue
 import sys
 import time
-import threading
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from zeitgeist.datamodel import Event, ResultType, Interpretation, TimeRange, \
     Subject, StorageState
 
 import content_objects
 import external
+from common import DayParts
+from config import settings
+from day_cache import DayCache
 from external import CLIENT, CLIENT_EXTENSION
 
 MAXEVENTS = 999999
+# Number of days, counting today, covered by the histogram at startup
+HISTORY_DAYS = 50 * 6
+# Milliseconds of main loop time a Day may spend inserting events per slice
+INGEST_TIME_BUDGET = 8
+# Number of days the PrefetchScheduler loads at the same time
+PREFETCH_JOBS = 2
+# PrefetchScheduler priorities, lower values are loaded first
+PRIORITY_VISIBLE = 0
+PRIORITY_NEIGHBOUR = 5
+PRIORITY_HISTORY = 10
+# Seconds after which a day which did not load gives its prefetch job up
+PREFETCH_TIMEOUT = 30
+# Default number of loaded days, and megabytes of their events, kept in memory
+LOADED_DAYS_BUDGET = 30
+LOADED_DAYS_MEMORY = 64
+# Default number of days whose events the DayCache keeps on disk
+CACHED_DAYS_BUDGET = 60
+# Default milliseconds during which changes are collected into one update
+UPDATE_INTERVAL = 50
+# Rough size of a loaded event with its ContentStruct and content object
+ITEM_SIZE_ESTIMATE = 4096
+# Days this close to the selected day or today are never unloaded
+FOCUS_MARGIN = 3
 
 tdelta = lambda x: datetime.timedelta(days=x)
 
@@ -44,13 +79,7 @@ def get_related_events_for_uri(uri, callback):
     the uris. It is called with a list of events.
     """
     def _event_request_handler(ids):
-        events = []
-        for id_ in ids:
-            try:
-                events.append(STORE.get_event_from_id(id_))
-            except KeyError as e:
-                print "%s" % e
-        callback(events)
+        STORE.get_events_from_ids(ids, callback)
 
     def _event_id_request_handler(uris):
         templates = []
@@ -77,17 +106,14 @@ def reduce_dates_by_timedelta(dates, delta):
     return new_dates
 
 
-class DoEmit(object):
+class DoQueueUpdate(object):
     """
-    Calls emit_update on the methods class
+    Queues an update of the method's day on its store's update bus
     """
-    def __init__(self, signal):
-        self.signal = signal
-
     def __call__(self, function):
         def wrapper(instance, *args, **kwargs):
             value = function(instance, *args, **kwargs)
-            instance.emit(self.signal)
+            instance.queue_update()
             return value
         return wrapper
 
@@ -109,24 +135,204 @@ class CachedAttribute(object):
         return value
 
 
-class ContentStruct(object):
-    id = 0
-    event = None
+class TemplateMatcher(object):
+    """
+    A compiled form of a template or a sequence of templates. Calling it
+    with an event returns True if the event matches any of the templates.
 
-    _content_object_built = False
-    @CachedAttribute
-    def content_object(self):
-        self._content_object_built = True
-        return content_objects.ContentObject.new_from_event(self.event)
+    Templates only look at the fields they set, so the result of
+    Event.matches_template is stored keyed by the values of those fields.
+    Events with one of the plain interpretations of the templates match
+    straight away.
+    """
+    def __init__(self, templates):
+        if isinstance(templates, Event):
+            templates = (templates,)
+        self.templates = tuple(templates)
+        event_fields = set()
+        subject_fields = set()
+        self._interpretations = set()
+        self._subjects = False
+        for template in self.templates:
+            fields = [i for i, value in enumerate(template[0]) if value]
+            event_fields.update(fields)
+            if template.subjects:
+                self._subjects = True
+                for subject in template.subjects:
+                    subject_fields.update(i for i, value in enumerate(subject) if value)
+            elif fields == [Event.Interpretation] and \
+                not template.interpretation.startswith("!"):
+                self._interpretations.add(template.interpretation)
+        self._event_fields = sorted(event_fields)
+        self._subject_fields = sorted(subject_fields)
+        self._interpretation_codes = set(INTERNED.code(interpretation)
+            for interpretation in self._interpretations)
+        self._results = {}
+
+    def _key(self, event):
+        values = event[0]
+        key = tuple([values[i] for i in self._event_fields])
+        if self._subjects:
+            fields = self._subject_fields
+            key += tuple([tuple([subject[i] for i in fields])
+                for subject in event.subjects])
+        return key
+
+    def _struct_key(self, record):
+        key = tuple([record.get_metadata(i) for i in self._event_fields])
+        if self._subjects:
+            fields = self._subject_fields
+            key += tuple([tuple([subject[i] for i in fields])
+                for subject in record.subjects])
+        return key
+
+    def _match(self, key, event):
+        try:
+            return self._results[key]
+        except KeyError:
+            pass
+        if not isinstance(event, Event):
+            event = event.to_event()
+        result = False
+        for template in self.templates:
+            if event.matches_template(template):
+                result = True
+                break
+        self._results[key] = result
+        return result
+
+    def __call__(self, event):
+        if event.interpretation in self._interpretations:
+            return True
+        return self._match(self._key(event), event)
+
+    def match_struct(self, struct):
+        """
+        Matches a ContentStruct without materializing its event
+        """
+        record = struct.record
+        if record is None:
+            return self(struct.event)
+        if record.interpretation in self._interpretation_codes:
+            return True
+        return self._match(self._struct_key(record), record)
 
-    @CachedAttribute
-    def event(self):
-        events = CLIENT._iface.GetEvents([self.id])
-        if events:
-            return Event(events[0])
+
+_template_matchers = {}#id(templates):(templates, TemplateMatcher)
+
+def compile_templates(templates):
+    """
+    :returns: a TemplateMatcher for a template or a sequence of templates.
+    Matchers are reused for as long as the same templates object is used.
+    """
+    try:
+        cached, matcher = _template_matchers[id(templates)]
+        if cached is templates:
+            return matcher
+    except KeyError:
+        pass
+    if len(_template_matchers) > 64:
+        _template_matchers.clear()
+    matcher = TemplateMatcher(templates)
+    _template_matchers[id(templates)] = (templates, matcher)
+    return matcher
+
+
+class InternTable(object):
+    """
+    Stores each distinct string once and maps it to a small integer code
+    """
+    def __init__(self):
+        self._codes = {}#string:code
+        self._values = []
+
+    def code(self, value):
+        try:
+            return self._codes[value]
+        except KeyError:
+            value = unicode(value)
+            code = self._codes[value] = len(self._values)
+            self._values.append(value)
+            return code
+
+    def value(self, code):
+        return self._values[code]
+
+    def intern(self, value):
+        return self._values[self.code(value)]
+
+INTERNED = InternTable()
+
+# Subject fields which repeat across events and are shared through INTERNED
+SUBJECT_INTERNED_FIELDS = (Subject.Interpretation, Subject.Manifestation,
+    Subject.Mimetype, Subject.Storage)
+
+
+class EventRecord(object):
+    """
+    A compact copy of a zeitgeist Event. Interpretations, manifestations
+    and actors are kept as INTERNED codes, subjects as tuples whose
+    repeating fields are interned.
+    """
+    __slots__ = ("id", "timestamp", "interpretation", "manifestation",
+        "actor", "metadata", "subjects", "payload")
+
+    def __init__(self, event):
+        metadata = event[0]
+        self.id = int(event.id)
+        self.timestamp = int(metadata[Event.Timestamp])
+        self.interpretation = INTERNED.code(metadata[Event.Interpretation])
+        self.manifestation = INTERNED.code(metadata[Event.Manifestation])
+        self.actor = INTERNED.code(metadata[Event.Actor])
+        self.metadata = tuple([unicode(value) for value in metadata[Event.Actor+1:]])
+        self.subjects = tuple([self._compact_subject(subject) for subject in event[1]])
+        self.payload = tuple(event[2]) if len(event) > 2 and event[2] else ()
+
+    @staticmethod
+    def _compact_subject(subject):
+        return tuple([INTERNED.intern(value) if i in SUBJECT_INTERNED_FIELDS
+            else unicode(value) for i, value in enumerate(subject)])
+
+    def get_metadata(self, field):
+        """
+        :returns: the value of the event metadata field, as in event[0][field]
+        """
+        if field == Event.Id:
+            return unicode(self.id)
+        if field == Event.Timestamp:
+            return unicode(self.timestamp)
+        if field == Event.Interpretation:
+            return INTERNED.value(self.interpretation)
+        if field == Event.Manifestation:
+            return INTERNED.value(self.manifestation)
+        if field == Event.Actor:
+            return INTERNED.value(self.actor)
+        return self.metadata[field - Event.Actor - 1]
+
+    def to_event(self):
+        metadata = [self.get_metadata(i) for i in xrange(Event.Actor + 1)]
+        metadata.extend(self.metadata)
+        return Event([metadata, [list(subject) for subject in self.subjects],
+                      list(self.payload)])
+
+
+
+class ContentStruct(object):
+    """
+    An event held by the store. Plain zeitgeist events are kept as an
+    EventRecord and materialized each time the event is asked for, unless
+    the content object holds it, use the timestamp, interpretation, actor
+    and uri accessors where possible.
+    """
+    __slots__ = ("id", "record", "_event", "_content_object",
+        "_content_object_built")
 
     def __init__(self, id, event=None, content_object=None, build=False):
         self.id = id
+        self.record = None
+        self._event = None
+        self._content_object = None
+        self._content_object_built = False
         if event:
             self.event = event
         if content_object:
@@ -134,13 +340,79 @@ class ContentStruct(object):
         if build:
             CLIENT.get_events([self.id], self.set_event)
 
+    def _get_event(self):
+        if self._event is None:
+            if self.record is not None:
+                # Not kept, the record is enough to rebuild it. A built
+                # content object holds one already.
+                if self._content_object is not None:
+                    return self._content_object.event
+                return self.record.to_event()
+            else:
+                events = CLIENT._iface.GetEvents([self.id])
+                if events:
+                    self._event = Event(events[0])
+        return self._event
+
+    def _set_event(self, event):
+        if type(event) is Event:
+            self.record = EventRecord(event)
+            self._event = None
+        else:
+            # Subclasses, like Hamster's events, are kept as they are
+            self.record = None
+            self._event = event
+
+    event = property(_get_event, _set_event)
+
+    def _get_content_object(self):
+        if not self._content_object_built:
+            self._content_object_built = True
+            self._content_object = content_objects.ContentObject.new_from_event(self.event)
+        return self._content_object
+
+    def _set_content_object(self, content_object):
+        self._content_object_built = True
+        self._content_object = content_object
+
+    def _del_content_object(self):
+        self._content_object_built = False
+        self._content_object = None
+
+    content_object = property(_get_content_object, _set_content_object,
+        _del_content_object)
+
+    @property
+    def timestamp(self):
+        if self.record is not None:
+            return self.record.timestamp
+        return int(self.event.timestamp)
+
+    @property
+    def interpretation(self):
+        if self.record is not None:
+            return INTERNED.value(self.record.interpretation)
+        return self.event.interpretation
+
+    @property
+    def actor(self):
+        if self.record is not None:
+            return INTERNED.value(self.record.actor)
+        return self.event.actor
+
+    @property
+    def uri(self):
+        if self.record is not None:
+            return self.record.subjects[0][Subject.Uri]
+        return self.event.subjects[0].uri
+
     def set_event(self, value):
         if isinstance(value, dbus.Array) or isinstance(value, list) or isinstance(value, tuple) and len(value):
             self.event = value[0]
         elif isinstance(value, Event):
             self.event = value
         else:
-            self.event = ContentStruct.event
+            self.event = None
         self.build_struct()
 
     def build_struct(self):
@@ -151,13 +423,189 @@ class ContentStruct(object):
         gtk.gdk.threads_leave()
 
 
+class TimeMap(object):
+    """
+    The timeline rows of a day, one per subject uri. A row is a list of
+    (item, start, duration) tuples, in milliseconds, where LEAVE events
+    close the interval opened by the previous event of the same uri.
+
+    Rows are recomputed only for the uris whose events change and every
+    change bumps the version, so views can ask for what changed since.
+    """
+    def __init__(self, start, items=()):
+        self.start = start * 1000
+        self.version = 0
+        self._events = {}#uri:[(timestamp, item)]
+        self._rows = {}#uri:row
+        self._changed = {}#uri:version of its last change
+        self._sorted_rows = None
+        for item in items:
+            events = self._events_for(item)
+            if events is not None:
+                events.append((item.timestamp, item))
+        for uri, events in self._events.iteritems():
+            events.sort(key=lambda x: x[0])
+            self._rows[uri] = self._make_row(events)
+
+    def _events_for(self, item, create=True):
+        uri = item.uri
+        if uri.startswith("http://") or uri.startswith("https://"):
+            return None
+        if create:
+            return self._events.setdefault(uri, [])
+        return self._events.get(uri)
+
+    def _make_row(self, events):
+        leave = Interpretation.LEAVE_EVENT.uri
+        row = []
+        for timestamp, item in events:
+            if item.interpretation != leave:
+                row.append((item, timestamp, 0))
+            elif row:
+                item, start, duration = row[-1]
+                row[-1] = (item, start, timestamp - start)
+            else:
+                row.append((item, self.start, timestamp - self.start))
+        return row
+
+    def _update(self, uri):
+        events = self._events.get(uri)
+        if events:
+            self._rows[uri] = self._make_row(events)
+        else:
+            self._events.pop(uri, None)
+            self._rows.pop(uri, None)
+        self.version += 1
+        self._changed[uri] = self.version
+        self._sorted_rows = None
+
+    def add(self, item):
+        events = self._events_for(item)
+        if events is None:
+            return
+        timestamp = item.timestamp
+        i = bisect.bisect_right([t for t, obj in events], timestamp)
+        events.insert(i, (timestamp, item))
+        self._update(item.uri)
+
+    def remove(self, item):
+        events = self._events_for(item, create=False)
+        if not events:
+            return
+        for i, (timestamp, obj) in enumerate(events):
+            if obj is item:
+                del events[i]
+                self._update(item.uri)
+                break
+
+    def get_rows(self):
+        """
+        :returns: the rows sorted by the start of their first interval
+        """
+        if self._sorted_rows is None:
+            self._sorted_rows = sorted(self._rows.itervalues(),
+                key=lambda row: row[0][1])
+        return self._sorted_rows
+
+    def get_changes(self, since):
+        """
+        :returns: the current version and a dict of uri: row for the uris
+        changed after version since, with None for rows which were removed
+        """
+        changes = {}
+        for uri, version in self._changed.iteritems():
+            if version > since:
+                changes[uri] = self._rows.get(uri)
+        return self.version, changes
+
+
+class DayColumns(object):
+    """
+    Parallel arrays over the items of a day, in time order: timestamps,
+    interpretation and actor codes from INTERNED and subject uri ids, which
+    are only numbered within the day. The counts use numpy when it is
+    available.
+    """
+    def __init__(self, start, items):
+        self.start = start * 1000
+        uri_ids = {}#uri:id
+        self.timestamps = array.array("d")
+        self.interpretations = array.array("i")
+        self.actors = array.array("i")
+        self.uris = array.array("i")
+        for item in items:
+            record = item.record
+            self.timestamps.append(item.timestamp)
+            if record is not None:
+                self.interpretations.append(record.interpretation)
+                self.actors.append(record.actor)
+            else:
+                self.interpretations.append(INTERNED.code(item.interpretation))
+                self.actors.append(INTERNED.code(item.actor))
+            self.uris.append(uri_ids.setdefault(item.uri, len(uri_ids)))
+        if numpy:
+            self.timestamps = numpy.array(self.timestamps, dtype=numpy.float64)
+            self.interpretations = numpy.array(self.interpretations, dtype=numpy.int32)
+            self.actors = numpy.array(self.actors, dtype=numpy.int32)
+            self.uris = numpy.array(self.uris, dtype=numpy.int32)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _utc_offsets(self):
+        """
+        :returns: the start of every hour from the day's start, in seconds,
+        and the UTC offset of the local time from each of them on
+        """
+        start = int(self.start // 1000)
+        bounds = [start + 3600 * i for i in xrange(26)]
+        offsets = [calendar.timegm(time.localtime(bound)) - bound
+                   for bound in bounds]
+        return bounds, offsets
+
+    def count_by_hour(self):
+        """
+        :returns: a list of the number of items in each of the 24 hours of
+        the local time, so an hour skipped by a DST change stays empty and
+        a repeated one holds both
+        """
+        bounds, offsets = self._utc_offsets()
+        if numpy:
+            seconds = self.timestamps // 1000
+            index = numpy.searchsorted(bounds, seconds, side="right") - 1
+            index = numpy.clip(index, 0, len(bounds) - 1)
+            hours = (seconds + numpy.array(offsets)[index]) // 3600 % 24
+            counts = numpy.bincount(hours.astype(numpy.int64), minlength=24)
+            return [int(count) for count in counts]
+        counts = [0] * 24
+        for timestamp in self.timestamps:
+            seconds = timestamp // 1000
+            index = max(bisect.bisect_right(bounds, seconds) - 1, 0)
+            counts[int((seconds + offsets[index]) // 3600 % 24)] += 1
+        return counts
+
+    def count_subjects(self):
+        """
+        :returns: the number of distinct subject uris
+        """
+        if numpy:
+            return len(numpy.unique(self.uris))
+        return len(set(self.uris))
+
+
 class Day(gobject.GObject):
     __gsignals__ = {
-        "update" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
+        "update" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+        # number of ingested events, number of events received so far
+        "progress" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                      (gobject.TYPE_INT, gobject.TYPE_INT)),
+        # all the events requested by load_ids were inserted
+        "loaded" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
 
     date = None
+    store = None
     start = 0
     end = 86400
 
@@ -176,42 +624,116 @@ class Day(gobject.GObject):
         subject.uri = "!application://*"
         return[Event.new_for_values(subjects = [subject], actor="!application://activity-log-manager.desktop")]
 
-    def __init__(self, date, days_population=None):
+    def __init__(self, date, population=None, store=None):
         super(Day, self).__init__()
         self.date = date
+        self.store = store
         self._items = {}#id:ContentItem
         self._loaded = False
+        self._pending_events = collections.deque()
+        self._ingest_source = None
+        self._loading = False
+        self._awaiting_reply = False#Zeitgeist was not done with load_ids yet
+        self._load_generation = 0#bumped by every load_ids
+        self._from_cache = False
+        self._cached_ids = set()#ids of the events painted from the cache
+        self._ingested = 0
+        self._received = 0
+        # Time ordered index of the items
+        self._times = array.array("d")#ascending event timestamps
+        self._sorted = []#ContentStructs, in the order of _times
+        self._parts = array.array("b")#DayParts index of each item
+        self._time_map = None
+        self._columns = None
         self.start = int(time.mktime(date.timetuple()))
         self.end = self.start+86399
-        self._population = None
-        if days_population:
-            for timestamp, count in days_population: # they are ordered descending
-                # Ugly hack to adjust for local/UTC time. Screw you timezones!
-                timestamp += (time.gmtime().tm_hour - time.localtime().tm_hour) * 3600 + \
-                    (time.gmtime().tm_min - time.localtime().tm_min) * 60
-                if timestamp >= self.start:
-                    if timestamp < self.end:
-                        self._population = count
-                        break
-                else:
-                    break
-        else:
+        self._population = population
+        self._hamster_ids = []
+        if population is None:
             self.load_ids()
-        if external.HAMSTER:
-            try:
-                facts = external.HAMSTER.get_facts(self.start, self.end)
-                for fact in facts:
-                    self.insert_events(None, fact.get_events())
-            except TypeError:
-                pass #print "Hamster support disabled temporarely"
+
+    @property
+    def _cache(self):
+        return self.store.cache if self.store is not None else None
 
     def load_ids(self):
         if not self._loaded:
             self._loaded = True
-            CLIENT.find_events_for_templates(self.templates, self.set_ids,
-                self.time_range, num_events=MAXEVENTS,
-                storage_state=StorageState.Available)
-            CLIENT.install_monitor(self.time_range, self.templates, self.insert_events, self.remove_ids)
+            self._loading = True
+            self._awaiting_reply = True
+            self._load_generation += 1
+            generation = self._load_generation
+            if self.store is not None:
+                self.store.update_count(self)
+            # Paint what the cache holds, then query Zeitgeist
+            if self._cache:
+                self._cache.get_events(self.date,
+                    lambda cached: self._set_cached_ids(cached, generation))
+            else:
+                self._set_cached_ids(None, generation)
+            self.load_hamster_events()
+            if self.store is not None:
+                self.store.day_loaded(self)
+
+    def _set_cached_ids(self, cached, generation):
+        """
+        Inserts the events the cache held for the day, None if it held
+        none or could not be read, and queries Zeitgeist for the day
+        """
+        if not self._loaded or generation != self._load_generation:
+            return
+        self._from_cache = cached is not None
+        self._cached_ids = set(event.id for event in cached or ())
+        if cached:
+            self.set_ids(cached)
+        CLIENT.find_events_for_templates(self.templates,
+            lambda events: self._set_found_ids(events, generation),
+            self.time_range, num_events=MAXEVENTS,
+            storage_state=StorageState.Available)
+
+    def load_hamster_events(self):
+        """
+        Replaces the day's Hamster events with those of Hamster's cache
+        """
+        if not external.HAMSTER:
+            return
+        try:
+            events = external.HAMSTER.get_events_for_date(self.date)
+        except (TypeError, dbus.DBusException):
+            return #print "Hamster support disabled temporarely"
+        if self._hamster_ids:
+            self.remove_ids(None, self._hamster_ids)
+        self._hamster_ids = [event.id for event in events]
+        if events:
+            self.insert_events(None, events)
+
+    def unload(self):
+        """
+        Drops the items of the day. The day keeps its size and loads again
+        the next time its items are needed.
+        """
+        if not self._loaded:
+            return
+        if self._ingest_source:
+            gobject.source_remove(self._ingest_source)
+            self._ingest_source = None
+        self._population = len(self._items)
+        if self.store is not None:
+            for id_ in self._items:
+                self.store.unindex_id(id_)
+        self._items = {}
+        self._hamster_ids = []
+        self._cached_ids = set()
+        self._pending_events.clear()
+        self._ingested = self._received = 0
+        self._times = array.array("d")
+        self._sorted = []
+        self._parts = array.array("b")
+        self._time_map = None
+        self._columns = None
+        self._loaded = self._loading = self._awaiting_reply = False
+        if self.store is not None:
+            self.store.update_count(self)
 
     def __getitem__(self, id_):
         self.load_ids()
@@ -226,39 +748,115 @@ class Day(gobject.GObject):
         if not self._loaded: self.load_ids()
         return self._items.has_key(id_)
 
-    @DoEmit("update")
-    def set_ids(self, event_ids):
-        deleted_uris = STORE.list_deleted_uris
-        for event in event_ids:
-            #let's update the GUI
-            gtk.gdk.threads_enter()
-            while gtk.events_pending():gtk.main_iteration(False)
-            gtk.gdk.threads_leave()
-            if deleted_uris is not None:
-                if event.subjects[0].uri not in deleted_uris:
-                    self._items[event.id] = ContentStruct(event.id, event)
-            else:
-                self._items[event.id] = ContentStruct(event.id, event)    
+    def _set_found_ids(self, events, generation):
+        """
+        Inserts the events Zeitgeist found for the day. If the day was
+        painted from the cache, only the differences are applied.
+
+        Replies to a load_ids which was followed by unload are dropped.
+        """
+        if not self._loaded or generation != self._load_generation:
+            return
+        self._awaiting_reply = False
+        found = events
+        changed = not self._from_cache
+        if self._from_cache:
+            ids = set(event.id for event in events)
+            # Only cached events can be stale, others (like Hamster's) were
+            # never asked from Zeitgeist
+            stale = [id_ for id_ in self._cached_ids if id_ not in ids]
+            self._cached_ids = set()
+            if stale:
+                self.remove_ids(None, stale)
+            known = set(self._items)
+            known.update(event.id for event in self._pending_events)
+            events = [event for event in events if event.id not in known]
+            changed = bool(stale or events)
+        if events or not self._from_cache:
+            self.set_ids(events)
+        elif self._loading and not self._ingest_source:
+            self._loading = False
+            self.emit("loaded")
+        if self._cache and changed:
+            # Written by the cache's writer thread
+            self._cache.set_events(self.date, found)
+
+    def set_ids(self, events):
+        """
+        Queues the events returned by Zeitgeist for insertion
 
-    @DoEmit("update")
+        The events are inserted from the main loop in slices which last at
+        most the configured time budget. Every slice queues a single 'update'
+        and a 'progress' signal.
+        """
+        self._pending_events.extend(events)
+        self._received += len(events)
+        if not self._ingest_source:
+            budget = settings.get("ingest_time_budget", INGEST_TIME_BUDGET)
+            self._ingest_budget = (budget or INGEST_TIME_BUDGET) / 1000.0
+            self._ingest_source = gobject.idle_add(self._ingest_slice)
+
+    def _ingest_slice(self):
+        store = self.store if self.store is not None else STORE
+        deleted_uris = store.deleted_uris
+        pending = self._pending_events
+        deadline = time.time() + self._ingest_budget
+        while pending:
+            event = pending.popleft()
+            self._ingested += 1
+            # Hide events from before their subject was deleted
+            deletion = deleted_uris.get(event.subjects[0].uri) if deleted_uris else None
+            if deletion is None or int(event.timestamp) > deletion:
+                self._add_struct(ContentStruct(event.id, event))
+            if time.time() >= deadline:
+                break
+        self.emit("progress", self._ingested, self._received)
+        self.queue_update()
+        if pending:
+            return True
+        self._ingest_source = None
+        self._ingested = self._received = 0
+        # Cached events may drain before Zeitgeist replies
+        if self._loading and not self._awaiting_reply:
+            self._loading = False
+            self.emit("loaded")
+        return False
+
+    def queue_update(self):
+        """
+        Emits 'update' through the store's update bus, which merges the
+        updates of a short interval into one
+        """
+        if self.store is not None:
+            self.store.updates.mark(self)
+        else:
+            self.emit("update")
+
+    @DoQueueUpdate()
     def remove_ids(self, time_range, ids):
+        if self._pending_events:
+            ids = set(ids)
+            pending = len(self._pending_events)
+            self._pending_events = collections.deque(
+                event for event in self._pending_events if event.id not in ids)
+            self._received -= pending - len(self._pending_events)
         for id_ in ids:
             try:
-                del self._items[id_]
+                self._remove_id(id_)
             except KeyError:
                 pass
 
-    @DoEmit("update")
+    @DoQueueUpdate()
     def insert_events(self, time_range, events):
         for event in events:
-            self._items[event.id] = ContentStruct(event.id, event)
+            self._add_struct(ContentStruct(event.id, event))
 
-    @DoEmit("update")
+    @DoQueueUpdate()
     def insert_event(self, event, overwrite=False):
         """
         Insert an event into the day object
 
-        Emits a 'update' signal
+        Queues a 'update' signal
         """
         return self._insert_event(event, overwrite)
 
@@ -269,12 +867,60 @@ class Day(gobject.GObject):
         if not overwrite and event.id in self._items:
             self._items[event.id].event = event
             return False
-        self._items[event.id] = ContentStruct(event.id, event)
+        struct = ContentStruct(event.id, event)
+        self._add_struct(struct)
         if overwrite:
-            self._items[event.id]._content_object_built = True
-            self._items[event.id].content_object = content_objects.ContentObject.new_from_event(event)
+            struct._content_object_built = True
+            struct.content_object = content_objects.ContentObject.new_from_event(event)
         return True
 
+    def _add_struct(self, struct):
+        """
+        Stores a ContentStruct in the day, its time index and the store's
+        id index
+        """
+        if struct.id in self._items:
+            self._unindex_struct(self._items[struct.id])
+        self._items[struct.id] = struct
+        timestamp = struct.timestamp
+        i = bisect.bisect_right(self._times, timestamp)
+        self._times.insert(i, timestamp)
+        self._sorted.insert(i, struct)
+        self._parts.insert(i, DayParts.get_day_part_for_timestamp(timestamp))
+        self._columns = None
+        if self._time_map is not None:
+            self._time_map.add(struct)
+        if self.store is not None:
+            self.store.index_struct(self.date, struct)
+            self.store.update_count(self)
+
+    def _remove_id(self, id_):
+        """
+        Removes the ContentStruct for id_ from the day, its time index and
+        the store's id index. Raises KeyError if the day does not hold id_
+        """
+        self._unindex_struct(self._items.pop(id_))
+        if self.store is not None:
+            self.store.unindex_id(id_)
+            self.store.update_count(self)
+
+    def _unindex_struct(self, struct):
+        timestamp = struct.timestamp
+        i = bisect.bisect_left(self._times, timestamp)
+        while i < len(self._times) and self._times[i] == timestamp:
+            if self._sorted[i] is struct:
+                break
+            i += 1
+        else:
+            # The event's timestamp was changed after it was indexed
+            i = self._sorted.index(struct)
+        del self._times[i]
+        del self._sorted[i]
+        del self._parts[i]
+        self._columns = None
+        if self._time_map is not None:
+            self._time_map.remove(struct)
+
     def next(self, store=None):
         """
         Return the next day in the given store
@@ -294,61 +940,82 @@ class Day(gobject.GObject):
         return store[date]
 
     def filter(self, event_template=None, result_type=None):
+        """
+        :returns: the items matching event_template, newest first
+        """
         self.load_ids()
+        #Newest first makes MODIFY/ACCESS_EVENT "more important" than CREATE ones
+        #Doing that, fx. tomboy's note names are updated - cando
         if event_template:
             items = self.filter_event_template(event_template)
-            items = self.filter_result_type(items, result_type)
-        elif result_type:
-            items = self.filter_result_type(self._items.values(), result_type)
         else:
-            items = self._items.values()
-        #I reverse the list to make MODIFY/ACCESS_EVENT "more important" than CREATE ones
-        #Doing that, fx. tomboy's note names are updated - cando
-        items.sort(key=lambda obj: int(obj.event.timestamp),reverse=True)
+            items = self._sorted[::-1]
+        if result_type:
+            items = self.filter_result_type(items, result_type)
         return items
 
     def filter_event_template(self, event_template):
-        items = []
-        if isinstance(event_template, Event):
-            for obj in self._items.values():
-                if obj.event.matches_template(event_template):
-                    items.append(obj)
-        elif event_template:
-            for template in event_template:
-                items += self.filter(template)
-            items = list(set(items))
-        return items
+        matches = compile_templates(event_template)
+        return [obj for obj in reversed(self._sorted) if matches.match_struct(obj)]
 
     def filter_result_type(self, items, result_type):
+        """
+        :param items: items sorted newest first, as returned by filter
+        """
         if items and result_type is ResultType.MostRecentSubjects:
-            item_dict = {}
+            uris = set()
+            results = []
             for item in items:
-                subject_uri = item.event.subjects[0].uri
-                item_dict[subject_uri] = item
-            items = item_dict.values()
+                subject_uri = item.uri
+                if subject_uri not in uris:
+                    uris.add(subject_uri)
+                    results.append(item)
+            items = results
         return items
 
+    def filter_day_parts(self, event_template=None, result_type=None):
+        """
+        :returns: a list for each of DayParts.get_day_parts() holding the
+        items of that part of the day which match event_template, newest
+        first. result_type is applied to each part separately.
+        """
+        self.load_ids()
+        matches = compile_templates(event_template) if event_template else None
+        parts = [[] for i in DayParts.get_day_parts()]
+        for i in xrange(len(self._sorted) - 1, -1, -1):
+            item = self._sorted[i]
+            if matches is None or matches.match_struct(item):
+                parts[self._parts[i]].append(item)
+        if result_type:
+            parts = [self.filter_result_type(part, result_type) for part in parts]
+        return parts
+
+    @property
+    def time_map(self):
+        """
+        The TimeMap of the day, built on first use and kept up to date
+        as events are added and removed
+        """
+        if self._time_map is None:
+            self.load_ids()
+            self._time_map = TimeMap(self.start, self._sorted)
+        return self._time_map
+
     def get_time_map(self):
-        start = self.start
-        results = {}
-        for item in self.items:
-            uri = item.event.subjects[0].uri
-            if uri.startswith("http://") or uri.startswith("https://"): continue
-            if not uri in results:
-                results[uri] = []
-            if not item.event.interpretation == Interpretation.LEAVE_EVENT.uri:
-                results[uri].append([item, 0])
-            else:
-                if not len(results[uri]) == 0:
-                    #print "***", results[uri]
-                    results[uri][len(results[uri])-1][1] = (int(item.event.timestamp)) -  int(results[uri][-1][0].event.timestamp)
-                else:
-                    tend = int(item.event.timestamp)/1000
-                    item.event.timestamp = str(start)
-                    results[uri].append([item, tend - start])
-        results = list(sorted(results.itervalues(), key=lambda r: \
-                             r[0][0].event.timestamp))
-        return results
+        return self.time_map.get_rows()
+
+    def get_time_map_changes(self, since):
+        return self.time_map.get_changes(since)
+
+    @property
+    def columns(self):
+        """
+        The DayColumns of the day, rebuilt on first use after a change
+        """
+        if self._columns is None:
+            self.load_ids()
+            self._columns = DayColumns(self.start, self._sorted)
+        return self._columns
 
     def __set_events_by_id(self, events):
         for event in events:
@@ -356,10 +1023,197 @@ class Day(gobject.GObject):
             self._items[event.id].build_struct()
 
 
+class PrefetchScheduler(gobject.GObject):
+    """
+    Loads days of a store in the background, at most max_jobs at a time.
+
+    Requested days are loaded by priority and newest first within the
+    same priority. A day keeps its job until all its events were
+    inserted, so the main loop is never handed more than max_jobs days
+    of events at once, or until PREFETCH_TIMEOUT if it does not load.
+    """
+    __gsignals__ = {
+        # number of days loaded, number of days requested
+        "progress" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                      (gobject.TYPE_INT, gobject.TYPE_INT)),
+        # every requested day was loaded or cancelled
+        "finished" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+    }
+
+    def __init__(self, store, max_jobs=PREFETCH_JOBS):
+        super(PrefetchScheduler, self).__init__()
+        self.store = store
+        self.max_jobs = max_jobs
+        self._heap = []#(priority, -ordinal, date)
+        self._queued = {}#date:priority
+        self._running = {}#date:(day, handler id)
+        self._done = 0
+
+    def request(self, dates, priority=PRIORITY_HISTORY):
+        """
+        Queues a date or a list of dates for loading. Dates which are
+        already queued are moved up if priority is lower than before.
+        """
+        if isinstance(dates, datetime.date):
+            dates = (dates,)
+        for date in dates:
+            if date in self._running:
+                continue
+            if self._queued.get(date, priority + 1) <= priority:
+                continue
+            self._queued[date] = priority
+            heapq.heappush(self._heap, (priority, -date.toordinal(), date))
+        self._schedule()
+
+    def cancel(self, dates=None):
+        """
+        Forgets the queued dates, or all of them if dates is None. Days
+        which are already loading are finished.
+        """
+        if dates is None:
+            self._queued.clear()
+            self._heap = []
+        else:
+            for date in dates:
+                self._queued.pop(date, None)
+        self._schedule()
+
+    def _schedule(self):
+        while self._heap and len(self._running) < self.max_jobs:
+            priority, ordinal, date = heapq.heappop(self._heap)
+            if self._queued.get(date) != priority:
+                continue # cancelled or requested again with a lower priority
+            del self._queued[date]
+            day = self.store[date]
+            if day._loaded and not day._loading:
+                self._done += 1
+                continue
+            handler = day.connect("loaded", self._on_day_loaded)
+            timeout = gobject.timeout_add_seconds(PREFETCH_TIMEOUT, self._on_day_timeout, date)
+            self._running[date] = (day, handler, timeout)
+            day.load_ids()
+        self.emit("progress", self._done,
+                  self._done + len(self._running) + len(self._queued))
+        if not self._running and not self._queued:
+            self._heap = []
+            if self._done:
+                self._done = 0
+                self.emit("finished")
+
+    def _on_day_loaded(self, day):
+        day, handler, timeout = self._running.pop(day.date)
+        day.disconnect(handler)
+        gobject.source_remove(timeout)
+        self._done += 1
+        self._schedule()
+
+    def _on_day_timeout(self, date):
+        """
+        Frees the job of a day whose query did not return
+        """
+        day, handler, timeout = self._running.pop(date)
+        day.disconnect(handler)
+        self._done += 1
+        self._schedule()
+        return False
+
+
+class EventResolver(object):
+    """
+    Resolves event ids into the store's ContentStructs in batches
+
+    Ids requested during one main loop iteration are fetched together with
+    a single GetEvents call from an idle callback. Ids the store already
+    holds are resolved without a query.
+    """
+    def __init__(self, store):
+        self.store = store
+        self._requests = []#(ids, callback)
+        self._source = None
+
+    def resolve(self, ids, callback):
+        """
+        Calls callback with the ContentStructs for ids, in the same order.
+        Ids for which Zeitgeist has no event are left out.
+        """
+        self._requests.append((list(ids), callback))
+        if not self._source:
+            self._source = gobject.idle_add(self._flush)
+
+    def _flush(self):
+        self._source = None
+        requests, self._requests = self._requests, []
+        index = self.store._id_index
+        missing = []
+        for ids, callback in requests:
+            for id_ in ids:
+                if id_ not in index:
+                    missing.append(id_)
+        if missing:
+            missing = list(set(missing))
+            # On an error the missing ids are delivered as unresolved
+            CLIENT.get_events(missing,
+                lambda events: self._deliver(requests, events),
+                error_handler=lambda error: self._deliver(requests, []))
+        else:
+            self._deliver(requests, [])
+        return False
+
+    def _deliver(self, requests, events):
+        for event in events:
+            if event:
+                self.store.get_struct_for_event(event)
+        index = self.store._id_index
+        for ids, callback in requests:
+            callback([index[id_][1] for id_ in ids if id_ in index])
+
+
+class UpdateBus(object):
+    """
+    Collects the days which changed during an interval, then emits one
+    'update' for each of them and one 'update' of the store with the set
+    of their dates
+    """
+    def __init__(self, store):
+        self.store = store
+        self._days = set()
+        self._dates = set()
+        self._source = None
+
+    def mark(self, day):
+        self._days.add(day)
+        self.mark_date(day.date)
+
+    def mark_date(self, date):
+        """
+        Queues a store update for date without an update of its day
+        """
+        self._dates.add(date)
+        if not self._source:
+            interval = settings.get("update_interval", UPDATE_INTERVAL)
+            self._source = gobject.timeout_add(interval, self.flush)
+
+    def flush(self):
+        if self._source:
+            gobject.source_remove(self._source)
+            self._source = None
+        days, self._days = self._days, set()
+        dates, self._dates = self._dates, set()
+        for day in days:
+            day.emit("update")
+        if dates:
+            self.store.emit("update", dates)
+        return False
+
+
 class Store(gobject.GObject):
     __gsignals__ = {
-        "update" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
+        # the set of dates which changed
+        "update" : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                    (gobject.TYPE_PYOBJECT,))
     }
+
+    cache = None
     
     @property
     def today(self):
@@ -367,36 +1221,64 @@ class Store(gobject.GObject):
 
     @property
     def days(self):
-        dates = self.dates
-        return [self._days[date] for date in dates]
+        """
+        Every day in dates. Note that this creates the Day objects which
+        do not exist yet, use dates and get_population where possible.
+        """
+        return [self[date] for date in self.dates]
 
     @property
     def dates(self):
-        dates = self._days.keys()
-        dates.sort()
-        return dates
+        """
+        The sorted dates of the histogram. The list is shared, do not
+        modify it.
+        """
+        today = datetime.date.today()
+        if self._last_date < today:
+            # The day changed since the dates were set up
+            while self._last_date < today:
+                self._last_date += tdelta(1)
+                self._add_date(self._last_date)
+        return self._dates
 
     @property
-    def list_deleted_uris(self):
+    def deleted_uris(self):
+        """
+        A dict of uri: timestamp of its last deletion
+        """
         return self._deleted_uris
 
+    @property
+    def list_deleted_uris(self):
+        return self._deleted_uris.keys()
+
     @property
     def loaded_items(self):
-        for day in self.days:
-            for item in day.items:
+        for date in sorted(self._days.iterkeys()):
+            for item in self._days[date]._items.values():
                 yield item
 
     def __init__(self):
         super(Store, self).__init__()
         self.run_build_thread = False
         self._days = {}
-        self._day_connections = {}
-        self._deleted_uris = []
+        self._dates = []#sorted dates of the histogram
+        self._counts = {}#date:number of events
+        self._count_values = collections.Counter()#number of events:number of dates
+        self._max_count = 0
+        self._total = 0
+        self.updates = UpdateBus(self)
+        self._id_index = {}#id:(date, ContentStruct)
+        self._loaded_days = collections.OrderedDict()#date:None, least recently used first
+        self._monitor = None
+        self._monitor_range = None
+        self._monitor_source = None
+        self._focus = datetime.date.today()
+        self.cache = DayCache.open(
+            max_days=settings.get("cached_days_budget", CACHED_DAYS_BUDGET))
         #Search for uris that have been deleted in order to not display them.
-        #FIXME we should add a timestamp field with the deleted uri
-        #to prevent that a recent event with same uri than an older and deleted one
-        #isn't displayed. - cando
-        self._deleted_uris = []
+        #Only events older than the deletion of their uri are hidden.
+        self._deleted_uris = self.cache.get_deleted_uris() if self.cache else {}#uri:timestamp
         subject = Subject()
         subject.uri = "!application://*"
         template = Event.new_for_values(interpretation=Interpretation.DELETE_EVENT.uri, 
@@ -405,61 +1287,345 @@ class Store(gobject.GObject):
         
         CLIENT.find_events_for_templates((template,), self.__set_deleted_uris,
             TimeRange.until_now(), num_events=MAXEVENTS)
-        global currentTimestamp, histogramLoaderCounter
+        CLIENT.install_monitor(TimeRange.from_now(), (template,),
+            self._on_deletions, lambda *args: None)
         today = datetime.date.today()
-        currentTimestamp = time.mktime(today.timetuple())
-        days_population = CLIENT_EXTENSION.GetHistogramData()
-        for i in xrange(50 * 6):
-            date = datetime.date.fromtimestamp(currentTimestamp)
-            day = Day(date, days_population)
-            self.add_day(date, day)
-            currentTimestamp -= 86400
-        for day in self.days[-6:]:
-            day.load_ids()
+        self._first_date = today - tdelta(HISTORY_DAYS - 1)
+        self._population = self.cache.get_population() if self.cache else {}#date:count
+        if self._population:
+            # Paint the histogram from the cache and refresh it in the background
+            CLIENT_EXTENSION.GetHistogramData(
+                reply_handler=self.__reconcile_population,
+                error_handler=lambda error: None)
+        else:
+            self.__set_population(CLIENT_EXTENSION.GetHistogramData())
+            if self.cache:
+                self.cache.set_population(self._population)
+        self._last_date = today
+        for i in xrange(HISTORY_DAYS):
+            self._add_date(self._first_date + tdelta(i))
+        self.prefetcher = PrefetchScheduler(self)
+        self.resolver = EventResolver(self)
+        if external.HAMSTER:
+            external.HAMSTER.connect_changed(self._on_hamster_changed)
+        # Days are only created when accessed, apart from the last few
+        self._fetch_hamster(today - tdelta(5), today)
+        self.prefetcher.request([today - tdelta(i) for i in xrange(6)],
+                                PRIORITY_VISIBLE)
         content_objects.AbstractContentObject.connect_to_manager("add", self.add_content_object_with_new_type)
         content_objects.AbstractContentObject.connect_to_manager("remove", self.remove_content_objects_with_type)
 
+    def _fetch_hamster(self, first, last):
+        """
+        Fetches the Hamster facts of the days from first to last with one
+        call, so the days about to load read them from Hamster's cache
+        """
+        if not external.HAMSTER:
+            return False
+        try:
+            external.HAMSTER.fetch_range(first, last)
+        except (TypeError, dbus.DBusException):
+            return False
+        return True
+
+    def _on_hamster_changed(self):
+        if not self._loaded_days:
+            return
+        # Refetch the loaded span with one call, the days then read the cache
+        if not self._fetch_hamster(min(self._loaded_days),
+                                   max(self._loaded_days)):
+            return
+        for date in self._loaded_days:
+            self._days[date].load_hamster_events()
+
+    def __set_population(self, days_population):
+        # Ugly hack to adjust for local/UTC time. Screw you timezones!
+        offset = (time.gmtime().tm_hour - time.localtime().tm_hour) * 3600 + \
+            (time.gmtime().tm_min - time.localtime().tm_min) * 60
+        for timestamp, count in days_population:
+            date = datetime.date.fromtimestamp(timestamp + offset)
+            self._population.setdefault(date, count)
+
+    def __reconcile_population(self, days_population):
+        self._population = {}
+        self.__set_population(days_population)
+        if self.cache:
+            self.cache.set_population(self._population)
+        for date, day in self._days.iteritems():
+            if not day._loaded and self._first_date <= date:
+                day._population = self._population.get(date, 0)
+        for date in self._dates:
+            self._set_count(date, self.get_population(date, False))
+        self.emit("update", set(self._population))
+
+    def _add_date(self, date):
+        i = bisect.bisect_left(self._dates, date)
+        if i < len(self._dates) and self._dates[i] == date:
+            return
+        self._dates.insert(i, date)
+        self._set_count(date, self.get_population(date, False))
+
+    def _set_count(self, date, count):
+        old = self._counts.get(date)
+        if old == count:
+            return
+        values = self._count_values
+        if old is not None:
+            values[old] -= 1
+            if not values[old]:
+                del values[old]
+            self._total -= old
+        self._counts[date] = count
+        values[count] += 1
+        self._total += count
+        if count > self._max_count:
+            self._max_count = count
+        elif old == self._max_count and old not in values:
+            self._max_count = max(values) if values else 0
+
+    def update_count(self, day):
+        """
+        Updates the running counts after the size of day changed
+        """
+        if day.date in self._counts:
+            self._set_count(day.date, len(day))
+
+    def get_max_population(self):
+        """
+        :returns: the largest number of events of a date in dates
+        """
+        return self._max_count
+
+    def get_date_index(self, date):
+        """
+        :returns: the index of date in dates, raises ValueError if missing
+        """
+        dates = self.dates
+        i = bisect.bisect_left(dates, date)
+        if i == len(dates) or dates[i] != date:
+            raise ValueError("%s not in dates" % date)
+        return i
+
+    def get_population(self, date, counted=True):
+        """
+        :returns: the number of events on date, without creating its Day
+        """
+        if counted and date in self._counts:
+            return self._counts[date]
+        try:
+            return len(self._days[date])
+        except KeyError:
+            return self._population.get(date, 0)
+
     def __set_deleted_uris(self, ids):
+        deleted_uris = {}#uri:timestamp of its last deletion
         for event in ids:
-            self._deleted_uris.append(event.subjects[0].uri)
+            uri = event.subjects[0].uri
+            deleted_uris[uri] = max(deleted_uris.get(uri, 0), int(event.timestamp))
+        self._deleted_uris = deleted_uris
+        if self.cache:
+            self.cache.set_deleted_uris(deleted_uris)
         return self._deleted_uris
 
+    def _on_deletions(self, time_range, events):
+        """
+        Records new deletions and hides the loaded events they cover
+        """
+        deleted = {}
+        for event in events:
+            uri = event.subjects[0].uri
+            timestamp = int(event.timestamp)
+            if timestamp > self._deleted_uris.get(uri, 0):
+                self._deleted_uris[uri] = deleted[uri] = timestamp
+        if not deleted:
+            return
+        if self.cache:
+            self.cache.set_deleted_uris(self._deleted_uris)
+        for date in self._loaded_days:
+            day = self._days[date]
+            ids = [item.id for item in day._items.itervalues()
+                if item.uri in deleted and item.timestamp <= deleted[item.uri]]
+            if ids:
+                day.remove_ids(time_range, ids)
+
     def add_content_object_with_new_type(self, obj):
-        for day in self.days:
-            for instance in day.items:
+        for day in self._days.values():
+            for instance in day._items.values():
                 if instance._content_object_built:
                     cls = content_objects.ContentObject.find_best_type_from_event(instance.event)
                     if not isinstance(instance.content_object, cls) and instance.content_object:
                         del instance.content_object
                         instance.content_object = cls.create(instance.event)
-            day.emit("update")
+            self.updates.mark(day)
 
     def remove_content_objects_with_type(self, obj):
-        for day in self.days:
-            for instance in day.items:
+        for day in self._days.values():
+            for instance in day._items.values():
                 if instance._content_object_built:
                     if isinstance(instance.content_object, obj) and instance.content_object:
                         instance.content_object = content_objects.ContentObject.new_from_event(instance.event)
-            day.emit("update")
+            self.updates.mark(day)
 
-    @DoEmit("update")
     def add_day(self, key, day):
         self._days[key] = day
-        self._day_connections[key] = day.connect("update", lambda *args: self.emit("update"))
+        day.store = self
+        self._add_date(key)
+        for struct in day._items.itervalues():
+            self.index_struct(key, struct)
+        if day._loaded:
+            self.day_loaded(day)
+        self.updates.mark_date(key)
+
+    def set_focus(self, date, dates=None):
+        """
+        Marks date as the selected day. Loaded days furthest from it are
+        unloaded first when the loaded days exceed their budget.
+
+        The prefetches queued for the previous selection are dropped, the
+        visible dates (date unless given) are loaded first, then the days
+        next to them.
+        """
+        self._focus = date
+        visible = sorted(dates or [date])
+        self.prefetcher.cancel()
+        neighbours = [neighbour for neighbour in
+            (visible[0] - tdelta(1), visible[-1] + tdelta(1))
+            if neighbour <= datetime.date.today()]
+        self._fetch_hamster(min(visible + neighbours), max(visible + neighbours))
+        self.prefetcher.request(visible, PRIORITY_VISIBLE)
+        self.prefetcher.request(neighbours, PRIORITY_NEIGHBOUR)
+        if date in self._loaded_days:
+            del self._loaded_days[date]
+            self._loaded_days[date] = None
+        self._enforce_budget()
+
+    def day_loaded(self, day):
+        if self._days.get(day.date) is not day:
+            return # add_day records it
+        self._loaded_days.pop(day.date, None)
+        self._loaded_days[day.date] = None
+        self._enforce_budget()
+        self._queue_monitor_update()
+
+    def _enforce_budget(self):
+        max_days = settings.get("loaded_days_budget", LOADED_DAYS_BUDGET)
+        max_bytes = settings.get("loaded_days_memory", LOADED_DAYS_MEMORY) * 1024 * 1024
+        count = len(self._loaded_days)
+        size = sum(len(self._days[date]._items) for date in self._loaded_days) * ITEM_SIZE_ESTIMATE
+        if count <= max_days and size <= max_bytes:
+            return
+        today = datetime.date.today()
+        for date in self._loaded_days.keys():
+            if count <= max_days and size <= max_bytes:
+                break
+            if abs((date - self._focus).days) <= FOCUS_MARGIN or \
+                abs((date - today).days) <= FOCUS_MARGIN:
+                continue
+            day = self._days[date]
+            if day._loading:
+                continue
+            size -= len(day._items) * ITEM_SIZE_ESTIMATE
+            count -= 1
+            del self._loaded_days[date]
+            day.unload()
+            self._queue_monitor_update()
+
+    def _queue_monitor_update(self):
+        if not self._monitor_source:
+            self._monitor_source = gobject.idle_add(self._update_monitor)
+
+    def _update_monitor(self):
+        """
+        Moves the store's monitor to the range between the first and the
+        last loaded day
+        """
+        self._monitor_source = None
+        time_range = None
+        if self._loaded_days:
+            first = self._days[min(self._loaded_days)]
+            last = self._days[max(self._loaded_days)]
+            time_range = [first.start*1000, last.end*1000]
+        if time_range == self._monitor_range:
+            return False
+        if self._monitor:
+            CLIENT.remove_monitor(self._monitor)
+            self._monitor = None
+        if time_range:
+            self._monitor = CLIENT.install_monitor(time_range, last.templates,
+                self._on_events_inserted, self._on_ids_deleted)
+        self._monitor_range = time_range
+        return False
+
+    def _on_events_inserted(self, time_range, events):
+        dates = {}#date:[events]
+        for event in events:
+            date = datetime.date.fromtimestamp(int(event.timestamp)/1000)
+            dates.setdefault(date, []).append(event)
+        for date, events in dates.iteritems():
+            day = self._days.get(date)
+            if day and day._loaded:
+                day.insert_events(time_range, events)
+            if self.cache:
+                self.cache.add_events(date, events)
+
+    def _on_ids_deleted(self, time_range, ids):
+        dates = {}#date:[ids]
+        unknown = []
+        for id_ in ids:
+            try:
+                dates.setdefault(self._id_index[id_][0], []).append(id_)
+            except KeyError:
+                unknown.append(id_)
+        for date, ids_ in dates.iteritems():
+            self._days[date].remove_ids(time_range, ids_)
+        if unknown:
+            # They may still be waiting to be inserted
+            for date in self._loaded_days:
+                if self._days[date]._pending_events:
+                    self._days[date].remove_ids(time_range, unknown)
+        if self.cache:
+            self.cache.remove_ids(ids)
+
+    def index_struct(self, date, struct):
+        self._id_index[struct.id] = (date, struct)
+
+    def unindex_id(self, id_):
+        self._id_index.pop(id_, None)
 
     def get_event_from_id(self, id_):
+        """
+        :returns: the ContentStruct for the event with id id_. Events which
+        are already held by a day are returned from the id index, others are
+        requested from Zeitgeist and added to their day.
+        """
+        try:
+            return self._id_index[id_][1]
+        except KeyError:
+            pass
         struct = ContentStruct(id_)
-        date = datetime.date.fromtimestamp(int(struct.event.timestamp)/1000)
-        if date in self.dates:
-            nstruct = self[date][id_]
-            nstruct.event = struct.event
-            del struct
-            return nstruct
-        else:
-            day = Day(date)
-            self.add_day(date, day)
-            day._items[id_] = struct
-            return struct
+        if not struct.event:
+            raise KeyError("%s Not found" % id_)
+        return self.get_struct_for_event(struct.event)
+
+    def get_events_from_ids(self, ids, callback):
+        """
+        Resolves ids asynchronously, batched with other requests, and calls
+        callback with the list of ContentStructs found
+        """
+        self.resolver.resolve(ids, callback)
+
+    def get_struct_for_event(self, event):
+        """
+        :returns: the indexed ContentStruct for event, adding event to its
+        day if no day holds it yet. The day itself is not loaded.
+        """
+        try:
+            return self._id_index[event.id][1]
+        except KeyError:
+            pass
+        date = datetime.date.fromtimestamp(int(event.timestamp)/1000)
+        self[date]._insert_event(event)
+        return self._id_index[event.id][1]
 
     def __getitem__(self, key):
         if isinstance(key, datetime.date):
@@ -467,70 +1633,40 @@ class Store(gobject.GObject):
             try:
                 return self._days[key]
             except KeyError:
-                day = Day(key)
+                # Days in the histogram range take their size from its data
+                population = None
+                if self._first_date <= key <= datetime.date.today():
+                    population = self._population.get(key, 0)
+                day = Day(key, population, self)
                 self.add_day(key, day)
                 return day
-        elif isinstance(key, int):
+        elif isinstance(key, (int, long)):
             # Return event id
-            for date, obj in self._days.iteritems():
-                if obj.has_id(id):
-                    return obj[id]
+            try:
+                return self._id_index[key][1]
+            except KeyError:
+                pass
         raise KeyError("%s Not found" % key)
 
     def __len__(self):
-        i = 0
-        for item in self._days.itervalues():
-            i+=len(item)
-        return i
+        return self._total
 
     def request_last_n_days_events(self, n=90, func=None):
         """
-        Find the events for 'n' days and packs them into the store
+        Loads the days from 3 to n+3 days ago in the background through
+        the prefetcher
 
-        Optionally calls func upon completion
+        Optionally calls func once every requested day is loaded
         """
-        subject = Subject()
-        subject.uri = "!application://*"
-        event_templates = (
-            Event.new_for_values(interpretation=Interpretation.ACCESS_EVENT.uri, subjects=[subject]),
-            Event.new_for_values(interpretation=Interpretation.MODIFY_EVENT.uri, subjects=[subject]),
-            Event.new_for_values(interpretation=Interpretation.CREATE_EVENT.uri, subjects=[subject]),
-            Event.new_for_values(interpretation=Interpretation.RECEIVE_EVENT.uri, subjects=[subject]),
-            Event.new_for_values(actor="!application://activity-log-manager.desktop")
-        )
-        
-        
-        def callback(events):
-            def _thread_fn(events):
-                event_chunks = []
-                chunk = []
-                for i, event in enumerate(events):
-                    chunk.append(event)
-                    if i%20 == 0:
-                        event_chunks.append(chunk)
-                        chunk = []
-                map(self.add_events, event_chunks)
-                if func:
-                    func()
-                return False
-
-            thread = threading.Thread(target=_thread_fn, args=(events,))
-            thread.start()
-
-        end = time.time() - 3*86400
-        start = end - n*86400
-        if n >= 60:
-            inc = (end - start)/(n/30)
-            for i in range(n/30):
-                a = end - (inc*(i+1)) + 1
-                b = end - (inc*(i))
-                CLIENT.find_events_for_templates(
-                    event_templates, callback, [a*1000, b*1000],
-                    num_events=50000, storage_state=StorageState.Available)
-        else:
-            CLIENT.find_events_for_templates(
-                event_templates, callback, [start*1000, end*1000],
-                num_events=50000, storage_state=StorageState.Available)
+        if func:
+            handler = []
+            def _finished(prefetcher):
+                prefetcher.disconnect(handler[0])
+                func()
+            handler.append(self.prefetcher.connect("finished", _finished))
+        today = datetime.date.today()
+        self.prefetcher.request([today - tdelta(i) for i in xrange(3, n + 3)],
+                                PRIORITY_HISTORY)
         return False
 
     def __add_event(self, event, overwrite):
@@ -561,18 +1697,25 @@ class Store(gobject.GObject):
         return matches
 
     def search_using_zeitgeist_fts(self, text, event_templates=None):
+        """
+        Runs in the search thread. The structs are built on the main loop,
+        which owns the days and the id index, and the thread waits for them.
+        """
         if not external.FTS:
             return []
         events = external.FTS.search(text, event_templates if event_templates else [])
-        ids = [int(event.id) for event in events]
-        results = []
-        for id_ in ids:
+        # FTS already returns complete events, so no GetEvents round trip is
+        # needed to build their structs
+        reply = Queue.Queue()
+        def build_structs():
+            structs = []
             try:
-                event = self.get_event_from_id(id_)
-                results.append(event)
-            except KeyError as e:
-                pass
-        return results
+                structs = [self.get_struct_for_event(event) for event in events]
+            finally:
+                reply.put(structs)
+            return False
+        gobject.idle_add(build_structs)
+        return reply.get()
 
     @property
     def fts_search_enabled(self):